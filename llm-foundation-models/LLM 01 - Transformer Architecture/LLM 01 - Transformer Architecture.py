@@ -30,6 +30,10 @@
 
 # COMMAND ----------
 
+# MAGIC %pip install torch==2.2.2
+
+# COMMAND ----------
+
 # Import the necessary libraries
 import torch
 import torch.nn as nn
@@ -536,6 +540,194 @@ print("\nGPT-2 XL completed.")
 
 # COMMAND ----------
 
+# MAGIC %md # Section 6: Compiling and exporting the decoder for inference
+# MAGIC
+# MAGIC So far our decoders have only run as eager PyTorch: every forward pass is interpreted operator by operator in Python. For serving we would rather hand the runtime a whole graph it can optimize and ship without the notebook. Generation has two phases, so we export two graphs:
+# MAGIC
+# MAGIC - **Prefill**: process the whole prompt at once and return the log-probabilities for every position.
+# MAGIC - **Decode**: process the running sequence and return only the log-probabilities of the next token.
+# MAGIC
+# MAGIC Our scratch decoders don't keep a key/value cache, so the decode step still attends over the full context, but it skips the vocabulary projection for every position except the last one. Each graph is produced three ways:
+# MAGIC
+# MAGIC - [`torch.compile`](https://pytorch.org/docs/stable/generated/torch.compile.html) - JIT-compiles the model in-process, the quickest win when we keep serving from Python.
+# MAGIC - [`torch.export`](https://pytorch.org/docs/stable/export.html) - captures a standalone `ExportedProgram` that can be saved and loaded without our class definitions.
+# MAGIC - [TorchScript](https://pytorch.org/docs/stable/jit.html) - the older serialized format, still the easiest to load from C++.
+# MAGIC
+# MAGIC The sequence length is marked as a dynamic dimension, so one artifact serves prompts of any length up to `max_seq_len`.
+# MAGIC
+# MAGIC Note: `torch.export` and its `save`/`load` functions need PyTorch 2.2 or later, which is why this notebook installs it at the top.
+
+# COMMAND ----------
+
+# The prefill graph is simply the decoder itself: log-probabilities for every position in the sequence.
+
+class DecoderPrefill(nn.Module):
+    def __init__(self, decoder):
+        super(DecoderPrefill, self).__init__()
+        self.decoder = decoder
+
+    def forward(self, x):
+        return self.decoder(x)
+
+# The decode graph only needs the next token, so after running the decoder blocks we project the last position alone.
+# It works for both our single-layer `TransformerDecoder` and the `MultiLayerTransformerDecoder`.
+
+class DecoderDecodeStep(nn.Module):
+    def __init__(self, decoder):
+        super(DecoderDecodeStep, self).__init__()
+        self.decoder = decoder
+        if isinstance(decoder, MultiLayerTransformerDecoder):
+            self.blocks = decoder.transformer_blocks
+        else:
+            self.blocks = nn.ModuleList([decoder.transformer_block])
+
+    def forward(self, x):
+        x = self.decoder.embedding(x)
+        x = self.decoder.pos_encoder(x)
+        # The mask only depends on the sequence length, so we build it once for all the blocks
+        tgt_mask = generate_square_subsequent_mask(x.size(0))
+        for block in self.blocks:
+            x = block(x, tgt_mask)
+        # Our decoders are sequence-first, so x[-1] holds the last position of every sequence in the batch
+        output = self.decoder.linear(x[-1])
+        return self.decoder.softmax(output)
+
+# COMMAND ----------
+
+import os
+from torch.export import Dim, export
+
+def export_decoder_graphs(decoder, example_input, max_seq_len=512):
+    """
+    Builds the prefill and decode graphs of a decoder with every backend.
+
+    Args:
+    decoder (nn.Module): A `TransformerDecoder` or `MultiLayerTransformerDecoder`.
+    example_input (torch.Tensor): Token ids of shape (sequence_length, batch_size) used to capture the graphs.
+    max_seq_len (int): The longest sequence the exported graphs have to accept.
+
+    Returns:
+    dict: Maps (phase, backend) to a callable, plus the raw `ExportedProgram` and TorchScript artifacts under "artifacts".
+    """
+    # Dropout must be disabled before capturing, otherwise it would be baked into the graphs
+    decoder.eval()
+    seq_len = Dim("seq_len", min=2, max=max_seq_len)
+
+    graphs = {"artifacts": {}}
+    for phase, wrapper in [("prefill", DecoderPrefill(decoder)), ("decode", DecoderDecodeStep(decoder))]:
+        wrapper.eval()
+        with torch.no_grad():
+            exported_program = export(wrapper, (example_input,), dynamic_shapes={"x": {0: seq_len}})
+            scripted = torch.jit.trace(wrapper, example_input, check_trace=False)
+
+        graphs[(phase, "eager")] = wrapper
+        graphs[(phase, "torch.compile")] = torch.compile(wrapper, dynamic=True)
+        graphs[(phase, "torch.export")] = exported_program.module()
+        graphs[(phase, "torchscript")] = scripted
+        graphs["artifacts"][phase] = {"torch.export": exported_program, "torchscript": scripted}
+    return graphs
+
+def save_decoder_graphs(graphs, directory):
+    """Writes the exported and TorchScript artifacts of every phase to `directory` and returns their paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for phase, artifacts in graphs["artifacts"].items():
+        paths[(phase, "torch.export")] = os.path.join(directory, f"decoder_{phase}.pt2")
+        torch.export.save(artifacts["torch.export"], paths[(phase, "torch.export")])
+        paths[(phase, "torchscript")] = os.path.join(directory, f"decoder_{phase}.ts")
+        torch.jit.save(artifacts["torchscript"], paths[(phase, "torchscript")])
+    return paths
+
+# COMMAND ----------
+
+# MAGIC %md ### A regression harness for the exported graphs
+# MAGIC
+# MAGIC A faster graph is only useful if it computes the same thing. The harness below runs every backend on sequences of several lengths, none of which were used to capture the graphs, and checks the outputs against eager PyTorch before timing them.
+
+# COMMAND ----------
+
+import pandas as pd
+
+def measure_latency(fn, inputs, n_iters=20):
+    """Returns the mean latency in milliseconds of `fn` over `inputs`, after one warm-up call per input."""
+    with torch.no_grad():
+        # The warm-up calls also trigger the compilation of torch.compile graphs, which we don't want to time
+        for x in inputs:
+            fn(x)
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            for x in inputs:
+                fn(x)
+    return 1000 * (time.perf_counter() - start) / (n_iters * len(inputs))
+
+def check_graph_regression(graphs, test_inputs, atol=1e-4, rtol=1e-4, n_iters=20):
+    """
+    Compares every exported graph against its eager counterpart, for numerical equality and latency.
+
+    Raises an AssertionError if any backend disagrees with eager PyTorch beyond `atol`/`rtol`.
+    """
+    rows = []
+    phases = sorted({key[0] for key in graphs if key != "artifacts"})
+    for phase in phases:
+        eager = graphs[(phase, "eager")]
+        eager_latency = measure_latency(eager, test_inputs, n_iters)
+        with torch.no_grad():
+            expected = [eager(x) for x in test_inputs]
+
+        for key, fn in graphs.items():
+            if key == "artifacts" or key[0] != phase:
+                continue
+            backend = key[1]
+            with torch.no_grad():
+                actual = [fn(x) for x in test_inputs]
+            max_abs_diff = max((a - e).abs().max().item() for a, e in zip(actual, expected))
+            matches = all(torch.allclose(a, e, atol=atol, rtol=rtol) for a, e in zip(actual, expected))
+            latency = eager_latency if backend == "eager" else measure_latency(fn, test_inputs, n_iters)
+            rows.append({"phase": phase,
+                         "backend": backend,
+                         "max_abs_diff": max_abs_diff,
+                         "matches_eager": matches,
+                         "latency_ms": latency,
+                         "speedup": eager_latency / latency})
+
+    results = pd.DataFrame(rows)
+    display(results)
+    mismatches = results[~results["matches_eager"]]
+    assert mismatches.empty, f"Exported graphs diverge from eager PyTorch:\n{mismatches}"
+    return results
+
+# COMMAND ----------
+
+# Define the hyperparameters
+vocab_size     = 10000
+d_model        = 512
+num_heads      = 8
+ff_hidden_dim  = 4*d_model
+dropout        = 0.1
+num_layers     = 4
+max_seq_len    = 512
+batch_size     = 1
+
+model = MultiLayerTransformerDecoder(vocab_size, d_model, num_heads, ff_hidden_dim, dropout, num_layers)
+
+# Capture the graphs with one sequence length...
+example_input = torch.randint(0, vocab_size, (32, batch_size))
+graphs = export_decoder_graphs(model, example_input, max_seq_len=max_seq_len)
+
+# ...and check them against others, to make sure the sequence length really is dynamic
+test_inputs = [torch.randint(0, vocab_size, (seq_len, batch_size)) for seq_len in [8, 50, 100, 300]]
+results = check_graph_regression(graphs, test_inputs)
+
+# COMMAND ----------
+
+# The exported artifacts can now be loaded without any of the classes defined in this notebook
+artifact_paths = save_decoder_graphs(graphs, os.path.join(DA.paths.working_dir, "llm01_decoder_graphs"))
+
+decode_step = torch.export.load(artifact_paths[("decode", "torch.export")]).module()
+print(decode_step(test_inputs[0]).shape)  # Should print torch.Size([batch_size, vocab_size])
+
+# COMMAND ----------
+
 # MAGIC %md-sandbox
 # MAGIC &copy; 2023 Databricks, Inc. All rights reserved.<br/>
 # MAGIC Apache, Apache Spark, Spark and the Spark logo are trademarks of the <a href="https://www.apache.org/">Apache Software Foundation</a>.<br/>
@@ -28,6 +28,10 @@
 
 # COMMAND ----------
 
+# MAGIC %pip install torch==2.2.2
+
+# COMMAND ----------
+
 # Import necessary libraries
 import torch
 import torch.nn as nn
@@ -645,6 +649,125 @@ dbTestQuestion1_9(sentence_q9)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC # Section 3 - Compiling and Exporting the Encoder for Inference
+# MAGIC
+# MAGIC Our encoder only runs as eager PyTorch. When we serve embeddings we would rather hand the runtime a whole graph it can optimize and ship without this notebook. An encoder has a single phase, so we produce one graph three ways, with the sequence length marked as a dynamic dimension:
+# MAGIC
+# MAGIC - [`torch.compile`](https://pytorch.org/docs/stable/generated/torch.compile.html) - JIT-compiles the model in-process.
+# MAGIC - [`torch.export`](https://pytorch.org/docs/stable/export.html) - captures a standalone `ExportedProgram` that can be saved and loaded without our class definitions.
+# MAGIC - [TorchScript](https://pytorch.org/docs/stable/jit.html) - the older serialized format, still the easiest to load from C++.
+# MAGIC
+# MAGIC We then check that every backend returns the same embeddings as eager PyTorch on sequence lengths that were not used for the capture, and compare their latency.
+
+# COMMAND ----------
+
+import os
+import time
+import pandas as pd
+from torch.export import Dim, export
+
+class EncoderInference(nn.Module):
+    # Exposes the encoder with a single tensor input, which is what the exporters expect
+    def __init__(self, encoder):
+        super(EncoderInference, self).__init__()
+        self.encoder = encoder
+
+    def forward(self, x):
+        return self.encoder(x, mask=None)
+
+def export_encoder_graphs(encoder, example_input, max_seq_len=512):
+    """
+    Builds the compiled, exported and TorchScript versions of an encoder.
+
+    Args:
+    encoder (TransformerEncoder): The encoder to export.
+    example_input (torch.Tensor): Token ids of shape (batch_size, sequence_length) used to capture the graphs.
+    max_seq_len (int): The longest sequence the exported graphs have to accept (at most 1000, the size of the position embedding).
+
+    Returns:
+    tuple: A dict mapping each backend to a callable, and a dict with the raw `ExportedProgram` and TorchScript artifacts.
+    """
+    # Dropout must be disabled before capturing, otherwise it would be baked into the graphs
+    encoder.eval()
+    wrapper = EncoderInference(encoder).eval()
+    seq_len = Dim("seq_len", min=2, max=max_seq_len)
+
+    with torch.no_grad():
+        exported_program = export(wrapper, (example_input,), dynamic_shapes={"x": {1: seq_len}})
+        scripted = torch.jit.trace(wrapper, example_input, check_trace=False)
+
+    graphs = {"eager": wrapper,
+              "torch.compile": torch.compile(wrapper, dynamic=True),
+              "torch.export": exported_program.module(),
+              "torchscript": scripted}
+    artifacts = {"torch.export": exported_program, "torchscript": scripted}
+    return graphs, artifacts
+
+def measure_latency(fn, inputs, n_iters=20):
+    """Returns the mean latency in milliseconds of `fn` over `inputs`, after one warm-up call per input."""
+    with torch.no_grad():
+        # The warm-up calls also trigger the compilation of torch.compile graphs, which we don't want to time
+        for x in inputs:
+            fn(x)
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            for x in inputs:
+                fn(x)
+    return 1000 * (time.perf_counter() - start) / (n_iters * len(inputs))
+
+def check_graph_regression(graphs, test_inputs, atol=1e-4, rtol=1e-4, n_iters=20):
+    """
+    Compares every backend against eager PyTorch, for numerical equality and latency.
+
+    Raises an AssertionError if any backend disagrees with eager PyTorch beyond `atol`/`rtol`.
+    """
+    with torch.no_grad():
+        expected = [graphs["eager"](x) for x in test_inputs]
+    eager_latency = measure_latency(graphs["eager"], test_inputs, n_iters)
+
+    rows = []
+    for backend, fn in graphs.items():
+        with torch.no_grad():
+            actual = [fn(x) for x in test_inputs]
+        latency = eager_latency if backend == "eager" else measure_latency(fn, test_inputs, n_iters)
+        rows.append({"backend": backend,
+                     "max_abs_diff": max((a - e).abs().max().item() for a, e in zip(actual, expected)),
+                     "matches_eager": all(torch.allclose(a, e, atol=atol, rtol=rtol) for a, e in zip(actual, expected)),
+                     "latency_ms": latency,
+                     "speedup": eager_latency / latency})
+
+    results = pd.DataFrame(rows)
+    display(results)
+    mismatches = results[~results["matches_eager"]]
+    assert mismatches.empty, f"Exported graphs diverge from eager PyTorch:\n{mismatches}"
+    return results
+
+# COMMAND ----------
+
+# Use the same hyperparameters as the encoder we built in Section 1
+encoder = TransformerEncoder(vocab_size, d_model, num_heads, conv_hidden_dim, num_layers, dropout)
+
+# Capture the graphs with one sequence length and check them against others
+example_input = torch.randint(0, vocab_size, (1, 32))
+graphs, artifacts = export_encoder_graphs(encoder, example_input)
+
+test_inputs = [torch.randint(0, vocab_size, (1, seq_len)) for seq_len in [5, 20, 100, 400]]
+results = check_graph_regression(graphs, test_inputs)
+
+# COMMAND ----------
+
+# Save the artifacts so they can be served without the classes defined in this notebook
+export_directory = os.path.join(DA.paths.working_dir, "llm01l_encoder_graphs")
+os.makedirs(export_directory, exist_ok=True)
+torch.export.save(artifacts["torch.export"], os.path.join(export_directory, "encoder.pt2"))
+torch.jit.save(artifacts["torchscript"], os.path.join(export_directory, "encoder.ts"))
+
+loaded_encoder = torch.jit.load(os.path.join(export_directory, "encoder.ts"))
+print(loaded_encoder(test_inputs[0]).shape)  # Should print torch.Size([1, 5, d_model])
+
+# COMMAND ----------
+
 # MAGIC %md-sandbox
 # MAGIC &copy; 2023 Databricks, Inc. All rights reserved.<br/>
 # MAGIC Apache, Apache Spark, Spark and the Spark logo are trademarks of the <a href="https://www.apache.org/">Apache Software Foundation</a>.<br/>
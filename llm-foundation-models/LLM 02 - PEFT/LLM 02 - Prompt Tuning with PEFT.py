@@ -274,6 +274,741 @@ print(tokenizer.batch_decode(text_outputs, skip_special_tokens=True))
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Packing short quotes into fixed-length blocks
+# MAGIC
+# MAGIC The quotes in `Abirate/english_quotes` are only a few dozen tokens long, and their lengths vary a lot. `DataCollatorForLanguageModeling` pads every batch to its longest quote, so a good share of every forward and backward pass is spent on pad tokens that don't contribute to the loss.
+# MAGIC
+# MAGIC Instead, we can **pack** several quotes into each row of a fixed-length block, separated by the EOS token, and only pad what is left at the end of each row. The collator below places the quotes of a batch with a first-fit-decreasing strategy (longest quotes first, each into the first row that still has room) and keeps track of how many pad tokens it had to add.
+# MAGIC
+# MAGIC Without anything else, quotes packed in the same row would attend to each other, and the model would learn to continue a quote from an unrelated one. BLOOM and the PEFT prompt-tuning wrapper only accept the usual 2D padding mask (the wrapper prepends the virtual tokens and extends that mask by one column per virtual token), so we can't simply pass a block-diagonal mask. Instead, with `document_attention=True` the collator also returns the `document_ids` of every token, and, inside a `with document_attention(model):` block, they are hooked into the causal mask BLOOM builds internally: each token then only attends to the virtual tokens and to earlier tokens of its own quote. BLOOM encodes positions with ALiBi, a bias that only depends on the distance between two tokens, so the positions don't need to restart at every quote.
+
+# COMMAND ----------
+
+import functools
+import torch
+from contextlib import contextmanager
+
+class DataCollatorForPackedLanguageModeling:
+    """
+    Packs tokenized examples into fixed-length rows for causal language modeling.
+
+    Args:
+    tokenizer: The tokenizer used to build the dataset, which provides the EOS and pad token ids.
+    block_size (int): The length of every packed row. Longer examples are truncated.
+    document_attention (bool): Whether to also return the `document_ids` of every token (-1 for padding), for `document_attention`.
+    """
+    def __init__(self, tokenizer, block_size=128, document_attention=False):
+        self.block_size = block_size
+        self.document_attention = document_attention
+        self.eos_token_id = tokenizer.eos_token_id
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_tokens = 0
+        self.num_pad_tokens = 0
+
+    @property
+    def padding_ratio(self):
+        # Fraction of all the tokens produced so far that are padding
+        return self.num_pad_tokens / max(self.num_tokens, 1)
+
+    def __call__(self, features):
+        # Every quote ends with an EOS token, so the model learns where one quote stops and the next one starts
+        documents = [list(feature["input_ids"])[:self.block_size - 1] + [self.eos_token_id] for feature in features]
+
+        # First-fit decreasing: place the longest quotes first, each into the first row that still has room
+        rows, row_lengths = [], []
+        for ids in sorted(documents, key=len, reverse=True):
+            for i, length in enumerate(row_lengths):
+                if length + len(ids) <= self.block_size:
+                    rows[i].append(ids)
+                    row_lengths[i] += len(ids)
+                    break
+            else:
+                rows.append([ids])
+                row_lengths.append(len(ids))
+
+        input_ids = torch.full((len(rows), self.block_size), self.pad_token_id, dtype=torch.long)
+        # document_ids holds the position of each token's quote within its row, and -1 for padding
+        document_ids = torch.full_like(input_ids, -1)
+        for i, row in enumerate(rows):
+            start = 0
+            for document_index, ids in enumerate(row):
+                input_ids[i, start:start + len(ids)] = torch.tensor(ids, dtype=torch.long)
+                document_ids[i, start:start + len(ids)] = document_index
+                start += len(ids)
+
+        is_token = document_ids >= 0
+        self.num_tokens += input_ids.numel()
+        self.num_pad_tokens += (~is_token).sum().item()
+
+        # Padding doesn't contribute to the loss
+        labels = input_ids.masked_fill(~is_token, -100)
+
+        batch = {"input_ids": input_ids, "attention_mask": is_token.long(), "labels": labels}
+        if self.document_attention:
+            batch["document_ids"] = document_ids
+        return batch
+
+@contextmanager
+def document_attention(model):
+    """
+    Within the block, a BLOOM model, optionally wrapped by PEFT, accepts the `document_ids` of DataCollatorForPackedLanguageModeling
+    and only attends within each document. Tokens prepended by PEFT, like the virtual tokens, are visible to all documents.
+
+    The foundation model may be shared with other adapters, so it is restored when the block exits.
+    """
+    base_model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    bloom = base_model.transformer
+    if "_prepare_attn_mask" in vars(bloom):
+        raise RuntimeError("Document attention is already enabled on this model")
+    state = {}
+    forward = model.forward
+    prepare_attn_mask = bloom._prepare_attn_mask
+
+    # functools.wraps keeps the signature of the original forward, which Trainer inspects to pick the dataset columns
+    @functools.wraps(forward)
+    def forward_with_document_ids(*args, document_ids=None, **kwargs):
+        # BLOOM rejects unknown arguments, so the document ids are kept aside for the mask below, for this forward pass only
+        state["document_ids"] = document_ids
+        try:
+            return forward(*args, **kwargs)
+        finally:
+            state.pop("document_ids", None)
+
+    def prepare_document_attn_mask(attention_mask, input_shape, past_key_values_length):
+        # BLOOM's mask is a boolean (batch, 1, query, key) tensor in which True means "masked"
+        mask = prepare_attn_mask(attention_mask, input_shape, past_key_values_length)
+        document_ids = state.get("document_ids")
+        if document_ids is None or past_key_values_length > 0:
+            return mask
+        num_prefix_tokens = mask.shape[-1] - document_ids.shape[1]
+        document_ids = torch.cat([document_ids.new_full((document_ids.shape[0], num_prefix_tokens), -2), document_ids.to(mask.device)], dim=1)
+        other_document = (document_ids.unsqueeze(2) != document_ids.unsqueeze(1)) & (document_ids != -2).unsqueeze(1)
+        return mask | other_document.unsqueeze(1)
+
+    model.forward = forward_with_document_ids
+    bloom._prepare_attn_mask = prepare_document_attn_mask
+    try:
+        yield model
+    finally:
+        # Removing the instance attributes brings back the methods of the classes
+        del model.forward
+        del bloom._prepare_attn_mask
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Let's compare how many tokens each collator produces for one epoch over `train_sample`, and how many of them are padding. Both collators mark padding with a `-100` label.
+
+# COMMAND ----------
+
+def collator_token_stats(dataset, data_collator, batch_size=8):
+    """Returns the total number of tokens a collator produces for one epoch over `dataset`, and the share of them that is padding."""
+    num_tokens, num_pad_tokens = 0, 0
+    for start in range(0, len(dataset), batch_size):
+        features = [{"input_ids": ids} for ids in dataset[start:start + batch_size]["input_ids"]]
+        batch = data_collator(features)
+        num_tokens += batch["labels"].numel()
+        num_pad_tokens += (batch["labels"] == -100).sum().item()
+    return num_tokens, num_pad_tokens / num_tokens
+
+packing_collator = DataCollatorForPackedLanguageModeling(tokenizer, block_size=128, document_attention=True)
+
+for name, data_collator in [("DataCollatorForLanguageModeling", DataCollatorForLanguageModeling(tokenizer, mlm=False)),
+                            ("DataCollatorForPackedLanguageModeling", packing_collator)]:
+    num_tokens, pad_ratio = collator_token_stats(train_sample, data_collator)
+    print(f"{name}: {num_tokens} tokens per epoch, {100 * pad_ratio:.1f}% padding")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC The packing collator is a drop-in replacement in `Trainer`. Document attention is only enabled around the training call, so the foundation model, which the adapters below share, is left unchanged afterwards. Each batch of quotes now becomes fewer, fuller rows, so every epoch needs fewer forward and backward passes over padding.
+
+# COMMAND ----------
+
+packed_peft_model = get_peft_model(foundation_model, peft_config)
+
+packing_collator.reset_stats()
+packed_trainer = Trainer(
+    model=packed_peft_model,
+    args=training_args,
+    train_dataset=train_sample,
+    data_collator=packing_collator
+)
+
+with document_attention(packed_peft_model):
+    packed_trainer.train()
+print(f"Padding ratio during training: {100 * packing_collator.padding_ratio:.1f}%")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Serving several adapters from one foundation model
+# MAGIC
+# MAGIC We now have several adapters trained on the same `bloomz-560m` foundation model: the randomly-initialized and the text-initialized prompt tuning adapters from this notebook, and the LoRA adapter from the lab. Loading each of them with `PeftModel.from_pretrained` wraps the foundation model separately, and serving them side by side would mean one copy of the 560M parameters per adapter.
+# MAGIC
+# MAGIC The adapters themselves are tiny, so a better approach is to keep **one** frozen copy of the foundation model and register the adapters by name next to it:
+# MAGIC
+# MAGIC - A prompt tuning adapter is just its learned virtual token embeddings, which we prepend to the embeddings of the rows that request it.
+# MAGIC - A LoRA adapter is a pair of low-rank matrices per target module. We wrap each target `Linear` layer of the foundation model so that it adds the low-rank update only to the rows that request that adapter.
+# MAGIC
+# MAGIC Requests for different adapters (or for the plain foundation model) can then share a single batched forward pass, and memory only grows by the size of each adapter.
+
+# COMMAND ----------
+
+import torch.nn as nn
+from peft import PeftConfig, PeftType
+from safetensors.torch import load_file
+
+def load_adapter_weights(adapter_path):
+    """Loads the state_dict of an adapter saved with `save_pretrained`, as safetensors (newer PEFT versions) or as a .bin file."""
+    safetensors_path = os.path.join(adapter_path, "adapter_model.safetensors")
+    if os.path.exists(safetensors_path):
+        return load_file(safetensors_path, device="cpu")
+    return torch.load(os.path.join(adapter_path, "adapter_model.bin"), map_location="cpu")
+
+class MultiLoRALinear(nn.Module):
+    """
+    Wraps a frozen `Linear` layer and adds the update of a different LoRA adapter to each group of rows in the batch.
+    """
+    def __init__(self, base_layer):
+        super(MultiLoRALinear, self).__init__()
+        self.base_layer = base_layer
+        self.lora_A, self.lora_B, self.scaling = {}, {}, {}
+        # List of (adapter_name, row indices) set by the server before every forward pass
+        self.row_groups = []
+
+    def forward(self, x):
+        output = self.base_layer(x)
+        for adapter_name, rows in self.row_groups:
+            if adapter_name in self.lora_A:
+                delta = (x[rows] @ self.lora_A[adapter_name].T) @ self.lora_B[adapter_name].T
+                output = output.index_add(0, rows, delta * self.scaling[adapter_name])
+        return output
+
+class MultiAdapterServer:
+    """
+    Serves many PEFT adapters from a single frozen copy of their foundation model.
+
+    Args:
+    foundation_model: The causal LM every adapter was trained on.
+    tokenizer: The tokenizer of the foundation model.
+    """
+    def __init__(self, foundation_model, tokenizer):
+        self.model = foundation_model.eval()
+        for param in self.model.parameters():
+            param.requires_grad_(False)
+        self.tokenizer = tokenizer
+        self.prompt_embeddings = {}
+        self.lora_layers = {}
+        self.adapter_bytes = {}
+
+    def register_adapter(self, adapter_name, adapter_path):
+        """Loads a prompt tuning or LoRA adapter saved with `save_pretrained` and registers it under `adapter_name`."""
+        config = PeftConfig.from_pretrained(adapter_path)
+        state_dict = load_adapter_weights(adapter_path)
+
+        if config.peft_type == PeftType.PROMPT_TUNING:
+            self.prompt_embeddings[adapter_name] = state_dict["prompt_embeddings"]
+        elif config.peft_type == PeftType.LORA:
+            scaling = config.lora_alpha / config.r
+            for key, weight in state_dict.items():
+                if ".lora_A." not in key:
+                    continue
+                # e.g. base_model.model.transformer.h.0.self_attention.query_key_value.lora_A.weight
+                module_name = key[len("base_model.model."):key.index(".lora_A.")]
+                layer = self._lora_layer(module_name)
+                layer.lora_A[adapter_name] = weight
+                layer.lora_B[adapter_name] = state_dict[key.replace(".lora_A.", ".lora_B.")]
+                layer.scaling[adapter_name] = scaling
+        else:
+            raise ValueError(f"Unsupported adapter type {config.peft_type} for {adapter_name}")
+
+        self.adapter_bytes[adapter_name] = sum(t.numel() * t.element_size() for t in state_dict.values())
+
+    def _lora_layer(self, module_name):
+        # Swap the target Linear layer for a MultiLoRALinear the first time an adapter targets it
+        if module_name not in self.lora_layers:
+            parent_name, child_name = module_name.rsplit(".", 1)
+            parent = self.model.get_submodule(parent_name)
+            layer = MultiLoRALinear(getattr(parent, child_name))
+            setattr(parent, child_name, layer)
+            self.lora_layers[module_name] = layer
+        return self.lora_layers[module_name]
+
+    def memory_report(self):
+        base_bytes = sum(p.numel() * p.element_size() for p in self.model.parameters())
+        print(f"Foundation model: {base_bytes / 1e6:.1f} MB (shared)")
+        for adapter_name, num_bytes in self.adapter_bytes.items():
+            print(f"Adapter {adapter_name}: {num_bytes / 1e6:.3f} MB")
+
+    @torch.no_grad()
+    def generate(self, requests, max_new_tokens=7):
+        """
+        Greedily generates a completion for each (adapter_name, prompt) request, all in the same batch.
+        Use adapter_name=None to query the foundation model without any adapter.
+        """
+        embedding_layer = self.model.get_input_embeddings()
+        rows = []
+        for adapter_name, prompt in requests:
+            input_ids = self.tokenizer(prompt, return_tensors="pt")["input_ids"][0]
+            row = embedding_layer(input_ids)
+            if adapter_name in self.prompt_embeddings:
+                # Prompt tuning: the virtual tokens go in front of the prompt
+                row = torch.cat([self.prompt_embeddings[adapter_name], row])
+            rows.append(row)
+
+        # Left-pad the rows, so that the next token of every row is generated at the last position
+        batch_size, max_length = len(rows), max(len(row) for row in rows)
+        inputs_embeds = torch.zeros(batch_size, max_length, rows[0].shape[-1])
+        attention_mask = torch.zeros(batch_size, max_length, dtype=torch.long)
+        for i, row in enumerate(rows):
+            inputs_embeds[i, max_length - len(row):] = row
+            attention_mask[i, max_length - len(row):] = 1
+
+        # Tell every LoRA layer which rows belong to which adapter
+        adapter_names = [adapter_name for adapter_name, _ in requests]
+        row_groups = [(name, torch.tensor([i for i, n in enumerate(adapter_names) if n == name]))
+                      for name in set(adapter_names) if name is not None]
+        for layer in self.lora_layers.values():
+            layer.row_groups = row_groups
+
+        outputs = self.model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, use_cache=True)
+        generated = []
+        finished = torch.zeros(batch_size, dtype=torch.bool)
+        for _ in range(max_new_tokens):
+            next_tokens = outputs.logits[:, -1].argmax(dim=-1).masked_fill(finished, self.tokenizer.pad_token_id)
+            generated.append(next_tokens)
+            finished |= next_tokens == self.tokenizer.eos_token_id
+            if finished.all():
+                break
+            attention_mask = torch.cat([attention_mask, torch.ones(batch_size, 1, dtype=torch.long)], dim=-1)
+            outputs = self.model(input_ids=next_tokens.unsqueeze(-1),
+                                 attention_mask=attention_mask,
+                                 past_key_values=outputs.past_key_values,
+                                 use_cache=True)
+
+        generated = torch.stack(generated, dim=1)
+        return [prompt + self.tokenizer.decode(tokens, skip_special_tokens=True)
+                for (_, prompt), tokens in zip(requests, generated)]
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC We load a fresh copy of the foundation model for the server, since the one above is already wrapped by several PEFT models. Then we register the adapters we saved in this notebook, and the LoRA adapter from the lab if you have already trained it.
+
+# COMMAND ----------
+
+import glob
+
+server = MultiAdapterServer(AutoModelForCausalLM.from_pretrained(model_name), tokenizer)
+server.register_adapter("prompt_random", peft_model_path)
+server.register_adapter("prompt_text", text_peft_model_path)
+
+lora_model_paths = sorted(glob.glob(os.path.join(DA.paths.working_dir, "peft_lab_outputs", "peft_model_*")))
+if lora_model_paths:
+    server.register_adapter("lora", lora_model_paths[-1])
+
+server.memory_report()
+
+# COMMAND ----------
+
+# One batch, one forward pass per generated token, a different adapter on every row
+requests = [(None, "Two things are infinite: "),
+            ("prompt_random", "Two things are infinite: "),
+            ("prompt_text", "Two things are infinite: "),
+            ("prompt_random", "Be yourself; ")]
+if "lora" in server.adapter_bytes:
+    requests.append(("lora", "Two things are infinite: "))
+
+for (adapter_name, _), output in zip(requests, server.generate(requests)):
+    print(f"{adapter_name}: {output}")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Caching the virtual tokens for inference
+# MAGIC
+# MAGIC With prompt tuning, the virtual tokens are the same for every request, yet each call to `generate` pushes them through all the BLOOM layers again. Because the model is causal, the keys and values of the virtual tokens never depend on the prompt that follows them. We can therefore compute them **once per adapter** and pass them to every request as `past_key_values`, so that only the prompt tokens go through the model.
+# MAGIC
+# MAGIC The wrapper below does this for any number of prompt tuning adapters sharing the same foundation model, and generates greedily from the cached prefix.
+
+# COMMAND ----------
+
+class PromptTuningPrefixCache:
+    """
+    Generates text with prompt tuning adapters from precomputed key/value states of their virtual tokens.
+
+    Args:
+    foundation_model: The causal LM the adapters were trained on.
+    tokenizer: The tokenizer of the foundation model.
+    """
+    def __init__(self, foundation_model, tokenizer):
+        self.model = foundation_model.eval()
+        self.tokenizer = tokenizer
+        self.prefixes = {}
+
+    @torch.no_grad()
+    def add_adapter(self, adapter_name, adapter_path):
+        """Runs the virtual tokens of a saved prompt tuning adapter through the model once and caches their keys and values."""
+        prompt_embeddings = load_adapter_weights(adapter_path)["prompt_embeddings"]
+        outputs = self.model(inputs_embeds=prompt_embeddings.unsqueeze(0), use_cache=True)
+        self.prefixes[adapter_name] = outputs.past_key_values
+
+    def _expand_prefix(self, adapter_name, batch_size):
+        # Repeating along the first dimension works whether it holds the batch or the batch and the heads flattened together (as in BLOOM)
+        return tuple(tuple(t.repeat(batch_size, *[1] * (t.dim() - 1)) for t in layer)
+                     for layer in self.prefixes[adapter_name])
+
+    @torch.no_grad()
+    def generate(self, adapter_name, prompts, max_new_tokens=7):
+        """Greedily generates a completion for each prompt in `prompts` with the adapter `adapter_name`."""
+        # Left-pad the prompts, so that the next token of every row is generated at the last position
+        padding_side, self.tokenizer.padding_side = self.tokenizer.padding_side, "left"
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        self.tokenizer.padding_side = padding_side
+        batch_size = inputs["input_ids"].shape[0]
+        num_virtual_tokens = self.prefixes[adapter_name][0][1].shape[-2]
+
+        # The attention mask covers the cached virtual tokens too
+        attention_mask = torch.cat([torch.ones(batch_size, num_virtual_tokens, dtype=torch.long), inputs["attention_mask"]], dim=-1)
+        outputs = self.model(input_ids=inputs["input_ids"],
+                             attention_mask=attention_mask,
+                             past_key_values=self._expand_prefix(adapter_name, batch_size),
+                             use_cache=True)
+
+        generated = []
+        finished = torch.zeros(batch_size, dtype=torch.bool)
+        for _ in range(max_new_tokens):
+            next_tokens = outputs.logits[:, -1].argmax(dim=-1).masked_fill(finished, self.tokenizer.pad_token_id)
+            generated.append(next_tokens)
+            finished |= next_tokens == self.tokenizer.eos_token_id
+            if finished.all():
+                break
+            attention_mask = torch.cat([attention_mask, torch.ones(batch_size, 1, dtype=torch.long)], dim=-1)
+            outputs = self.model(input_ids=next_tokens.unsqueeze(-1),
+                                 attention_mask=attention_mask,
+                                 past_key_values=outputs.past_key_values,
+                                 use_cache=True)
+
+        generated = torch.stack(generated, dim=1)
+        return [prompt + self.tokenizer.decode(tokens, skip_special_tokens=True) for prompt, tokens in zip(prompts, generated)]
+
+# COMMAND ----------
+
+prefix_cache = PromptTuningPrefixCache(AutoModelForCausalLM.from_pretrained(model_name), tokenizer)
+prefix_cache.add_adapter("prompt_random", peft_model_path)
+prefix_cache.add_adapter("prompt_text", text_peft_model_path)
+
+# The cached prefix gives the same greedy completion as the PEFT model, which recomputes the virtual tokens
+print(prefix_cache.generate("prompt_random", ["Two things are infinite: "]))
+print(tokenizer.batch_decode(loaded_model_outputs, skip_special_tokens=True))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Let's compare the latency of both approaches over a stream of single-prompt requests, as a serving endpoint would receive them.
+
+# COMMAND ----------
+
+request_prompts = [quote[:40] for quote in data["train"]["quote"][100:120]]
+
+start = time.perf_counter()
+for prompt in request_prompts:
+    request = tokenizer(prompt, return_tensors="pt")
+    loaded_model.generate(input_ids=request["input_ids"], attention_mask=request["attention_mask"], max_new_tokens=7, eos_token_id=tokenizer.eos_token_id)
+peft_latency = (time.perf_counter() - start) / len(request_prompts)
+
+start = time.perf_counter()
+for prompt in request_prompts:
+    prefix_cache.generate("prompt_random", [prompt], max_new_tokens=7)
+cached_latency = (time.perf_counter() - start) / len(request_prompts)
+
+print(f"PeftModel.generate: {1000 * peft_latency:.1f} ms per request")
+print(f"Cached virtual tokens: {1000 * cached_latency:.1f} ms per request")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Finding a batch size for CPU training
+# MAGIC
+# MAGIC We passed `auto_find_batch_size=True` together with `no_cuda=True` above. That option only halves the batch size when CUDA runs out of memory, so on a CPU cluster it never does anything: we simply train with the default batch size of 8, whether or not the cluster could do better.
+# MAGIC
+# MAGIC On CPU the question is rather which batch size gives the best throughput while staying within the memory we can afford. The probe below runs a few forward and backward passes at increasing batch sizes, records the peak resident memory (RSS) of the process and the number of samples processed per second, and stops as soon as the memory budget is exceeded. It then picks the fastest batch size and the number of gradient accumulation steps that keeps the effective batch size we asked for.
+
+# COMMAND ----------
+
+import threading
+import psutil
+
+class PeakRSSMonitor:
+    """Samples the resident memory of the current process in a background thread and keeps the peak."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+def find_cpu_batch_size(model, dataset, data_collator, memory_budget_gb=None, target_batch_size=8,
+                        candidate_batch_sizes=(1, 2, 4, 8, 16, 32, 64), num_steps=3):
+    """
+    Probes training steps at increasing batch sizes and picks the one with the best throughput within a memory budget.
+
+    Args:
+    model: The model to be trained. Its weights are not modified, and its gradients are cleared after every probe.
+    dataset: The tokenized training dataset. The probe uses its longest examples, so the memory measured is a worst case.
+    data_collator: The data collator that will be used for training.
+    memory_budget_gb (float): The peak RSS allowed for the process. Defaults to 80% of the memory currently in use or available.
+    target_batch_size (int): The effective batch size to keep with gradient accumulation.
+    candidate_batch_sizes (tuple): The batch sizes to try, in increasing order. Only the divisors of `target_batch_size` are probed,
+    so that the batch size times the accumulation steps is exactly `target_batch_size`.
+    num_steps (int): The number of timed training steps per batch size.
+
+    Returns:
+    dict: The chosen `per_device_train_batch_size` and `gradient_accumulation_steps`, and the measurements of every probe.
+    """
+    if memory_budget_gb is None:
+        memory_budget_gb = 0.8 * (psutil.Process().memory_info().rss + psutil.virtual_memory().available) / 1e9
+
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    longest_first = sorted(range(len(dataset)), key=lambda i: lengths[i], reverse=True)
+
+    candidate_batch_sizes = [batch_size for batch_size in candidate_batch_sizes
+                             if batch_size <= target_batch_size and target_batch_size % batch_size == 0]
+    assert candidate_batch_sizes, f"None of the candidate batch sizes divides target_batch_size={target_batch_size}"
+
+    model.train()
+    probes = []
+    for batch_size in candidate_batch_sizes:
+        indices = [longest_first[i % len(longest_first)] for i in range(batch_size)]
+        batch = data_collator([{"input_ids": dataset[i]["input_ids"]} for i in indices])
+
+        with PeakRSSMonitor() as monitor:
+            # The first step is a warm-up and isn't timed
+            model(**batch).loss.backward()
+            start = time.perf_counter()
+            for _ in range(num_steps):
+                model(**batch).loss.backward()
+            elapsed = time.perf_counter() - start
+        model.zero_grad(set_to_none=True)
+
+        probe = {"batch_size": batch_size,
+                 "peak_rss_gb": monitor.peak / 1e9,
+                 "samples_per_s": batch_size * num_steps / elapsed,
+                 "within_budget": monitor.peak / 1e9 <= memory_budget_gb}
+        probes.append(probe)
+        print(probe)
+        if not probe["within_budget"]:
+            break
+
+    candidates = [probe for probe in probes if probe["within_budget"]]
+    assert candidates, f"Even a batch size of {candidate_batch_sizes[0]} exceeds the memory budget of {memory_budget_gb:.1f} GB"
+    best = max(candidates, key=lambda probe: probe["samples_per_s"])
+    return {"per_device_train_batch_size": best["batch_size"],
+            "gradient_accumulation_steps": target_batch_size // best["batch_size"],
+            "probes": probes}
+
+# COMMAND ----------
+
+cpu_peft_model = get_peft_model(foundation_model, peft_config)
+batch_size_search = find_cpu_batch_size(cpu_peft_model,
+                                        train_sample,
+                                        DataCollatorForLanguageModeling(tokenizer, mlm=False),
+                                        target_batch_size=8)
+print(f"per_device_train_batch_size={batch_size_search['per_device_train_batch_size']}, "
+      f"gradient_accumulation_steps={batch_size_search['gradient_accumulation_steps']}")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC We then pass the batch size and gradient accumulation steps we found to `TrainingArguments`, instead of `auto_find_batch_size`.
+
+# COMMAND ----------
+
+cpu_training_args = TrainingArguments(
+    output_dir=output_directory,
+    no_cuda=True,
+    per_device_train_batch_size=batch_size_search["per_device_train_batch_size"],
+    gradient_accumulation_steps=batch_size_search["gradient_accumulation_steps"], # Keeps the effective batch size we asked for
+    learning_rate= 3e-2,
+    num_train_epochs=5
+)
+
+cpu_trainer = Trainer(
+    model=cpu_peft_model,
+    args=cpu_training_args,
+    train_dataset=train_sample,
+    data_collator=DataCollatorForLanguageModeling(tokenizer, mlm=False)
+)
+
+cpu_trainer.train()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## A content-addressed store for adapters
+# MAGIC
+# MAGIC So far every run is saved to a new `peft_model_{time.time()}` directory. Re-running a cell saves an identical adapter again under a new name, and every load has to read it back from a path that has never been seen before.
+# MAGIC
+# MAGIC Instead, we can name each adapter after a hash of its contents: its weights and its configuration. Saving an adapter that is already in the store is then a no-op, and the same hash always points to the same files. On top of that, the store keeps the most recently loaded adapters in memory, so loading one again is instant, and only keeps a bounded number of adapters on disk. Human-readable tags (like the repository names we would use with `push_to_hub`) point to a hash, so the store can stand in for the Hugging Face hub while we iterate.
+
+# COMMAND ----------
+
+import hashlib
+import json
+import shutil
+import tempfile
+from collections import OrderedDict
+from peft import PeftModel
+
+class AdapterStore:
+    """
+    Stores PEFT adapters on local disk under the hash of their weights and configuration.
+
+    Args:
+    root (str): The directory of the store.
+    max_loaded (int): How many loaded adapters to keep in memory.
+    max_stored (int): How many adapters to keep on disk. The least recently used ones are deleted first, together with their tags.
+    """
+    def __init__(self, root, max_loaded=4, max_stored=32):
+        self.root = root
+        self.max_loaded = max_loaded
+        self.max_stored = max_stored
+        self.loaded = OrderedDict()
+        os.makedirs(os.path.join(root, "adapters"), exist_ok=True)
+        os.makedirs(os.path.join(root, "tags"), exist_ok=True)
+
+    @staticmethod
+    def content_hash(adapter_path):
+        """Hashes the weights and configuration saved in `adapter_path`."""
+        digest = hashlib.sha256()
+        with open(os.path.join(adapter_path, "adapter_config.json")) as f:
+            config = json.load(f)
+        # Whether the adapter was saved for training or inference doesn't change its contents
+        config.pop("inference_mode", None)
+        digest.update(json.dumps(config, sort_keys=True).encode())
+
+        # Hash the tensors rather than the file, whose bytes may differ between two saves of the same weights
+        state_dict = load_adapter_weights(adapter_path)
+        for name in sorted(state_dict):
+            tensor = state_dict[name].contiguous()
+            digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+            # NumPy has no bfloat16, so hash the raw bytes of the tensor instead of converting it
+            digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+        return digest.hexdigest()
+
+    def path(self, reference):
+        """Returns the directory of an adapter, given its hash or one of its tags."""
+        tag_path = os.path.join(self.root, "tags", reference)
+        if os.path.exists(tag_path):
+            with open(tag_path) as f:
+                reference = f.read().strip()
+        adapter_path = os.path.join(self.root, "adapters", reference)
+        if not os.path.exists(adapter_path):
+            raise KeyError(f"No adapter {reference} in the store")
+        return adapter_path
+
+    def put(self, peft_model, tag=None):
+        """Saves `peft_model`'s adapter to the store unless an identical one is already there, and returns its hash."""
+        staging_path = tempfile.mkdtemp(dir=self.root)
+        peft_model.save_pretrained(staging_path)
+        content_hash = self.content_hash(staging_path)
+
+        adapter_path = os.path.join(self.root, "adapters", content_hash)
+        if os.path.exists(adapter_path):
+            shutil.rmtree(staging_path)
+            os.utime(adapter_path)  # Mark it as recently used
+        else:
+            os.rename(staging_path, adapter_path)
+            self._evict_stored()
+
+        if tag is not None:
+            with open(os.path.join(self.root, "tags", tag), "w") as f:
+                f.write(content_hash)
+        return content_hash
+
+    def load(self, reference, foundation_model):
+        """
+        Returns a `PeftModel` for the adapter `reference` (a hash or a tag) on top of `foundation_model`.
+
+        Note that loading a LoRA adapter injects its layers into `foundation_model`, like `PeftModel.from_pretrained` does, and
+        that they stay there when the model is dropped from the in-memory cache: PEFT 0.4 can't unload them without merging.
+        Load LoRA adapters on their own copy of the foundation model if it is shared.
+        """
+        adapter_path = self.path(reference)
+        key = (os.path.basename(adapter_path), id(foundation_model))
+        if key in self.loaded:
+            self.loaded.move_to_end(key)
+            return self.loaded[key]
+
+        model = PeftModel.from_pretrained(foundation_model, adapter_path, is_trainable=False)
+        os.utime(adapter_path)
+        self.loaded[key] = model
+        if len(self.loaded) > self.max_loaded:
+            self.loaded.popitem(last=False)
+        return model
+
+    def _evict_stored(self):
+        adapters_dir = os.path.join(self.root, "adapters")
+        adapter_paths = sorted((os.path.join(adapters_dir, name) for name in os.listdir(adapters_dir)), key=os.path.getmtime)
+        evicted = set()
+        for adapter_path in adapter_paths[:max(0, len(adapter_paths) - self.max_stored)]:
+            shutil.rmtree(adapter_path)
+            evicted.add(os.path.basename(adapter_path))
+        # Delete the tags of the evicted adapters, which would point to nothing
+        tags_dir = os.path.join(self.root, "tags")
+        for tag in os.listdir(tags_dir):
+            with open(os.path.join(tags_dir, tag)) as f:
+                content_hash = f.read().strip()
+            if content_hash in evicted:
+                os.remove(os.path.join(tags_dir, tag))
+
+# COMMAND ----------
+
+adapter_store = AdapterStore(os.path.join(output_directory, "adapter_store"))
+
+# Saving the same adapter twice stores it only once
+random_hash = adapter_store.put(trainer.model, tag="bloom_prompt_tuning_random")
+print(random_hash == adapter_store.put(trainer.model))
+text_hash = adapter_store.put(text_trainer.model, tag="bloom_prompt_tuning_text")
+print(os.listdir(os.path.join(adapter_store.root, "adapters")))
+
+# COMMAND ----------
+
+# The first load reads the adapter from disk, the second one is served from memory
+for _ in range(2):
+    start = time.perf_counter()
+    stored_model = adapter_store.load("bloom_prompt_tuning_random", foundation_model)
+    print(f"Loaded in {1000 * (time.perf_counter() - start):.1f} ms")
+
+stored_model_outputs = stored_model.generate(
+    input_ids=input1["input_ids"], 
+    attention_mask=input1["attention_mask"], 
+    max_new_tokens=7, 
+    eos_token_id=tokenizer.eos_token_id
+    )
+print(tokenizer.batch_decode(stored_model_outputs, skip_special_tokens=True))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Share model to HuggingFace hub (optional)
 # MAGIC
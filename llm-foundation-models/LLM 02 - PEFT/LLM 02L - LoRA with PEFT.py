@@ -244,6 +244,403 @@ dbTestQuestion2_5(outputs)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Merging LoRA adapters for deployment
+# MAGIC
+# MAGIC An unmerged `PeftModel` keeps `W_a` and `W_b` next to the frozen weights, so every token generated at inference time pays for extra low-rank matmuls on `query_key_value`. Once training is done we don't need them to stay separate: the update `W_b W_a` has the same shape as the frozen weight, so we can add it to the foundation model weights once and get back a plain `bloomz-560m` architecture. 
+# MAGIC
+# MAGIC `merge_and_unload()` does exactly that, and the result can be saved as a standalone model that loads with `AutoModelForCausalLM`, without PEFT. Below, we export the merged model, check that it produces the same logits as the unmerged one, and compare the generation latency and memory of the foundation, unmerged and merged models on CPU.
+# MAGIC
+# MAGIC API docs:
+# MAGIC * [merge_and_unload](https://huggingface.co/docs/peft/main/en/package_reference/tuners#peft.LoraModel.merge_and_unload)
+
+# COMMAND ----------
+
+import pandas as pd
+import psutil
+import torch
+
+def merge_and_export_lora(peft_model, export_path, tokenizer):
+    """
+    Merges the LoRA weights of `peft_model` into its foundation model and saves the result as a standalone model.
+    Note that the foundation model is modified in place.
+    """
+    merged_model = peft_model.merge_and_unload()
+    merged_model.save_pretrained(export_path)
+    tokenizer.save_pretrained(export_path)
+    return merged_model
+
+def process_rss_bytes():
+    return psutil.Process().memory_info().rss
+
+def benchmark_generation(name, model, tokenizer, prompt, rss_before, max_new_tokens=20, n_iters=5):
+    """
+    Measures the CPU generation latency and memory of `model`, always generating exactly `max_new_tokens` tokens.
+
+    The process also holds every model loaded earlier in the notebook, so the memory is reported as the growth of the
+    resident set size (RSS) since `rss_before`, measured right before loading `model`, plus the bytes of its own weights.
+    """
+    inputs = tokenizer(prompt, return_tensors="pt")
+    generate_kwargs = dict(input_ids=inputs["input_ids"],
+                           attention_mask=inputs["attention_mask"],
+                           max_new_tokens=max_new_tokens,
+                           min_new_tokens=max_new_tokens,
+                           eos_token_id=tokenizer.eos_token_id)
+    with torch.no_grad():
+        model.generate(**generate_kwargs)  # warm-up
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            model.generate(**generate_kwargs)
+        latency = (time.perf_counter() - start) / n_iters
+
+    weight_bytes = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    return {"model": name,
+            "latency_s": latency,
+            "ms_per_token": 1000 * latency / max_new_tokens,
+            "weights_mb": weight_bytes / 1e6,
+            "rss_delta_mb": (process_rss_bytes() - rss_before) / 1e6}
+
+# COMMAND ----------
+
+prompt = "Two things are infinite: "
+results = []
+
+# Load a fresh copy of the foundation model, since `foundation_model` above already has LoRA layers injected
+rss_before = process_rss_bytes()
+base_model = AutoModelForCausalLM.from_pretrained(model_name)
+results.append(benchmark_generation("foundation", base_model, tokenizer, prompt, rss_before))
+
+# Wrap the same copy with the adapter we saved above: the RSS delta is what the adapter adds on top of the foundation model
+rss_before = process_rss_bytes()
+unmerged_model = PeftModel.from_pretrained(base_model, peft_model_path, is_trainable=False)
+results.append(benchmark_generation("unmerged LoRA", unmerged_model, tokenizer, prompt, rss_before))
+
+# Keep the logits of the unmerged model, to check the merged one against them
+check_inputs = tokenizer(prompt, return_tensors="pt")
+with torch.no_grad():
+    unmerged_logits = unmerged_model(**check_inputs).logits
+
+merged_model_path = os.path.join(output_directory, "merged_model")
+merge_and_export_lora(unmerged_model, merged_model_path, tokenizer)
+
+# The exported model is a plain BLOOM checkpoint: no PEFT needed to load it
+rss_before = process_rss_bytes()
+merged_model = AutoModelForCausalLM.from_pretrained(merged_model_path)
+with torch.no_grad():
+    merged_logits = merged_model(**check_inputs).logits
+print(f"Max absolute difference between merged and unmerged logits: {(merged_logits - unmerged_logits).abs().max().item():.2e}")
+
+results.append(benchmark_generation("merged LoRA", merged_model, tokenizer, prompt, rss_before))
+display(pd.DataFrame(results))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Sweeping LoRA configurations in parallel
+# MAGIC
+# MAGIC Above we hand-picked `r` and `target_modules` and trained a single configuration. To choose them properly we would like to try many configurations, but training them one at a time leaves most of the CPU cores of the cluster idle, and loading one copy of `bloomz-560m` per configuration quickly runs out of memory.
+# MAGIC
+# MAGIC Since the foundation model is frozen, every configuration can read the very same weights. We move them once into shared memory with [`share_memory()`](https://pytorch.org/docs/stable/generated/torch.nn.Module.html#torch.nn.Module.share_memory) and train each configuration in its own worker process, with its share of the CPU threads. Each worker only allocates its own LoRA weights and optimizer state. The results are collected into a leaderboard of loss vs. number of trainable parameters vs. step time.
+
+# COMMAND ----------
+
+import itertools
+import queue
+import matplotlib.pyplot as plt
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from peft import LoraConfig, get_peft_model
+from transformers import DataCollatorForLanguageModeling
+
+def train_lora_config(config_id, config, base_model, batches, num_steps, learning_rate, num_threads, result_queue):
+    """Trains one LoRA configuration on top of the shared frozen `base_model` and reports its metrics to `result_queue`."""
+    try:
+        torch.set_num_threads(num_threads)
+        lora_config = LoraConfig(r=config["r"],
+                                 lora_alpha=1,
+                                 target_modules=config["target_modules"],
+                                 lora_dropout=0.05,
+                                 bias="none",
+                                 task_type="CAUSAL_LM")
+        # Injecting the LoRA layers only changes this process' copy of the module tree: the frozen weights stay shared
+        model = get_peft_model(base_model, lora_config)
+        model.train()
+        trainable_params = [param for param in model.parameters() if param.requires_grad]
+        optimizer = torch.optim.AdamW(trainable_params, lr=learning_rate)
+
+        losses, step_times = [], []
+        for step in range(num_steps):
+            batch = batches[step % len(batches)]
+            start = time.perf_counter()
+            loss = model(**batch).loss
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            step_times.append(time.perf_counter() - start)
+            losses.append(loss.item())
+
+        # Average the last few steps, to smooth out the noise of single batches
+        last_losses = losses[-max(1, num_steps // 5):]
+        result_queue.put({"config_id": config_id,
+                          "r": config["r"],
+                          "target_modules": ",".join(config["target_modules"]),
+                          "trainable_params": sum(param.numel() for param in trainable_params),
+                          "final_loss": sum(last_losses) / len(last_losses),
+                          # The first step includes one-off allocations, so it is left out of the timing
+                          "step_time_s": sum(step_times[1:]) / max(1, len(step_times) - 1)})
+    except Exception as e:
+        result_queue.put({"config_id": config_id, "error": repr(e)})
+
+def run_lora_sweep(base_model, configs, batches, num_workers=4, num_steps=30, learning_rate=3e-2, timeout_s=3600, poll_interval_s=5):
+    """
+    Trains every LoRA configuration in `configs` in parallel worker processes sharing one frozen `base_model`.
+
+    A configuration fails if its worker raises, dies without reporting (for instance when it is killed for running out of
+    memory) or runs for longer than `timeout_s` seconds. Failed configurations are kept in the leaderboard with their error.
+
+    Returns:
+    pd.DataFrame: One row per configuration, sorted by final training loss.
+    """
+    for param in base_model.parameters():
+        param.requires_grad_(False)
+    # The frozen weights are moved to shared memory once, instead of being copied into every worker
+    base_model.share_memory()
+
+    num_threads = max(1, os.cpu_count() // num_workers)
+    context = mp.get_context("fork")
+    result_queue = context.Queue()
+    pending = list(enumerate(configs))
+    running, results = {}, {}
+
+    def finish(config_id, result):
+        process, _ = running.pop(config_id)
+        process.join(timeout=poll_interval_s)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        if "error" not in result and process.exitcode != 0:
+            result = {"config_id": config_id, "error": f"worker exited with code {process.exitcode}"}
+        results[config_id] = result
+
+    while pending or running:
+        while pending and len(running) < num_workers:
+            config_id, config = pending.pop(0)
+            process = context.Process(target=train_lora_config,
+                                      args=(config_id, config, base_model, batches, num_steps, learning_rate, num_threads, result_queue))
+            process.start()
+            running[config_id] = (process, time.perf_counter())
+        # Wait for any worker to report, but never forever: a worker killed by the OS never puts a result
+        try:
+            result = result_queue.get(timeout=poll_interval_s)
+            finish(result["config_id"], result)
+            continue
+        except queue.Empty:
+            pass
+        for config_id, (process, start) in list(running.items()):
+            if not process.is_alive():
+                finish(config_id, {"config_id": config_id, "error": f"worker exited with code {process.exitcode} without a result"})
+            elif time.perf_counter() - start > timeout_s:
+                process.terminate()
+                finish(config_id, {"config_id": config_id, "error": f"timed out after {timeout_s}s"})
+
+    leaderboard = pd.DataFrame([results[config_id] for config_id in sorted(results)])
+    if "error" in leaderboard:
+        failed = leaderboard[leaderboard["error"].notna()]
+        print(f"{len(failed)} configuration(s) failed:\n{failed[['config_id', 'error']]}")
+    if "final_loss" not in leaderboard:
+        return leaderboard
+    return leaderboard.sort_values("final_loss", na_position="last").reset_index(drop=True)
+
+# COMMAND ----------
+
+# Collate the training batches once in the driver, the workers inherit them
+data_collator = DataCollatorForLanguageModeling(tokenizer, mlm=False)
+sweep_batches = [data_collator([{"input_ids": ids} for ids in train_sample[start:start + 8]["input_ids"]])
+                 for start in range(0, len(train_sample), 8)]
+
+sweep_configs = [{"r": r, "target_modules": target_modules}
+                 for r, target_modules in itertools.product([1, 4, 16],
+                                                            [["query_key_value"],
+                                                             ["query_key_value", "dense"],
+                                                             ["dense_h_to_4h", "dense_4h_to_h"]])]
+
+# A fresh copy of the foundation model, since `foundation_model` above already has LoRA layers injected
+sweep_base_model = AutoModelForCausalLM.from_pretrained(model_name)
+leaderboard = run_lora_sweep(sweep_base_model, sweep_configs, sweep_batches, num_workers=4)
+display(leaderboard)
+
+# COMMAND ----------
+
+fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+for ax, column, label in [(axes[0], "trainable_params", "Trainable parameters"), (axes[1], "step_time_s", "Step time (s)")]:
+    ax.scatter(leaderboard[column], leaderboard["final_loss"], s=100)
+    for _, row in leaderboard.iterrows():
+        ax.annotate(f"r={row['r']} {row['target_modules']}", xy=(row[column], row["final_loss"]), fontsize=8)
+    ax.set_xlabel(label)
+    ax.set_ylabel("Final training loss")
+axes[0].set_xscale("log")
+plt.tight_layout()
+plt.show()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Training LoRA on top of int8 frozen weights
+# MAGIC
+# MAGIC With LoRA only `W_a` and `W_b` receive gradients, yet the frozen foundation weights are still stored in 32-bit floating point, which is what limits the size of the models we can fine-tune on our CPU clusters. Since they never change, we can store them as 8-bit integers instead, with one scale per output channel, and dequantize them on the fly in the forward pass. The LoRA weights stay in `float32` (or `bfloat16`) so that training is unaffected.
+# MAGIC
+# MAGIC Two details matter to actually save memory:
+# MAGIC - If we dequantized the weight and called `F.linear`, autograd would keep the dequantized `float32` weight of every layer around for the backward pass. A small custom autograd function saves the int8 weight instead and dequantizes it again in the backward pass.
+# MAGIC - In `bloomz-560m`, almost half of the parameters are in the word embeddings, which are tied to the language modeling head. We quantize that matrix too, with one scale per vocabulary row, and share the int8 copy between the embedding lookup and the head.
+
+# COMMAND ----------
+
+import gc
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+def quantize_per_channel(weight):
+    """Symmetric int8 quantization of a 2D weight with one scale per row (output channel)."""
+    scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+    weight_int8 = torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+    return weight_int8, scale.to(torch.float32)
+
+class Int8LinearFunction(torch.autograd.Function):
+    # Computes x @ W^T with W stored as int8 and saves only the int8 weight for the backward pass
+    @staticmethod
+    def forward(ctx, x, weight_int8, scale, bias):
+        ctx.save_for_backward(weight_int8, scale)
+        output = F.linear(x, weight_int8.to(x.dtype)) * scale.to(x.dtype)
+        if bias is not None:
+            output = output + bias
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight_int8, scale = ctx.saved_tensors
+        # The frozen weight, scale and bias don't need gradients, only the input does
+        grad_input = (grad_output * scale.to(grad_output.dtype)) @ weight_int8.to(grad_output.dtype)
+        return grad_input, None, None, None
+
+class Int8Linear(nn.Module):
+    """A frozen `Linear` layer whose weight is stored as int8 with per-channel scales."""
+    def __init__(self, weight_int8, scale, bias=None):
+        super(Int8Linear, self).__init__()
+        self.register_buffer("weight_int8", weight_int8)
+        self.register_buffer("scale", scale)
+        self.register_buffer("bias", None if bias is None else bias.detach().clone())
+
+    @classmethod
+    def from_linear(cls, linear):
+        return cls(*quantize_per_channel(linear.weight.detach()), linear.bias)
+
+    def forward(self, x):
+        return Int8LinearFunction.apply(x, self.weight_int8, self.scale, self.bias)
+
+class Int8LoRALinear(Int8Linear):
+    """An `Int8Linear` layer with a trainable LoRA update `W_b W_a`, kept in `adapter_dtype`."""
+    def __init__(self, weight_int8, scale, bias=None, r=1, lora_alpha=1, lora_dropout=0.0, adapter_dtype=torch.float32):
+        super(Int8LoRALinear, self).__init__(weight_int8, scale, bias)
+        out_features, in_features = weight_int8.shape
+        self.lora_A = nn.Linear(in_features, r, bias=False, dtype=adapter_dtype)
+        self.lora_B = nn.Linear(r, out_features, bias=False, dtype=adapter_dtype)
+        self.lora_dropout = nn.Dropout(lora_dropout)
+        self.scaling = lora_alpha / r
+        # Same initialization as PEFT: the update starts at zero
+        nn.init.kaiming_uniform_(self.lora_A.weight, a=math.sqrt(5))
+        nn.init.zeros_(self.lora_B.weight)
+
+    @classmethod
+    def from_linear(cls, linear, **lora_kwargs):
+        return cls(*quantize_per_channel(linear.weight.detach()), linear.bias, **lora_kwargs)
+
+    def forward(self, x):
+        output = super(Int8LoRALinear, self).forward(x)
+        lora_output = self.lora_B(self.lora_A(self.lora_dropout(x).to(self.lora_A.weight.dtype)))
+        return output + lora_output.to(x.dtype) * self.scaling
+
+class Int8Embedding(nn.Module):
+    """A frozen embedding whose table is stored as int8 with one scale per row."""
+    def __init__(self, weight_int8, scale):
+        super(Int8Embedding, self).__init__()
+        self.register_buffer("weight_int8", weight_int8)
+        self.register_buffer("scale", scale)
+
+    def forward(self, input_ids):
+        return F.embedding(input_ids, self.weight_int8).to(self.scale.dtype) * self.scale[input_ids].unsqueeze(-1)
+
+def prepare_int8_lora_model(model, target_modules, r=1, lora_alpha=1, lora_dropout=0.05, adapter_dtype=torch.float32):
+    """
+    Freezes `model`, stores its Linear and embedding weights as int8 and adds LoRA adapters to `target_modules`.
+    The model is modified in place and returned.
+    """
+    for param in model.parameters():
+        param.requires_grad_(False)
+
+    input_embeddings, output_embeddings = model.get_input_embeddings(), model.get_output_embeddings()
+    tied = output_embeddings is not None and output_embeddings.weight is input_embeddings.weight
+
+    # The tied embedding matrix is quantized once and shared by the embedding lookup and the language modeling head
+    int8_embedding = Int8Embedding(*quantize_per_channel(input_embeddings.weight.detach()))
+    model.set_input_embeddings(int8_embedding)
+    if tied:
+        model.set_output_embeddings(Int8Linear(int8_embedding.weight_int8, int8_embedding.scale))
+
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if not isinstance(child, nn.Linear) or (tied and child is output_embeddings):
+                continue
+            if child_name in target_modules:
+                new_child = Int8LoRALinear.from_linear(child, r=r, lora_alpha=lora_alpha, lora_dropout=lora_dropout, adapter_dtype=adapter_dtype)
+            else:
+                new_child = Int8Linear.from_linear(child)
+            setattr(module, child_name, new_child)
+
+    # Release the float32 weights we just replaced
+    gc.collect()
+    return model
+
+def weight_memory_mb(model):
+    tensors = {t.data_ptr(): t for t in list(model.parameters()) + list(model.buffers())}  # Shared tensors only count once
+    return sum(t.numel() * t.element_size() for t in tensors.values()) / 1e6
+
+# COMMAND ----------
+
+int8_model = AutoModelForCausalLM.from_pretrained(model_name)
+fp32_weight_mb = weight_memory_mb(int8_model)
+int8_model = prepare_int8_lora_model(int8_model, target_modules=["query_key_value"], r=1, lora_alpha=1, lora_dropout=0.05)
+
+trainable_params = sum(p.numel() for p in int8_model.parameters() if p.requires_grad)
+print(f"Weights in float32: {fp32_weight_mb:.0f} MB, with int8 frozen weights: {weight_memory_mb(int8_model):.0f} MB")
+print(f"Trainable LoRA parameters: {trainable_params:,}")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC The int8 model is still a regular `transformers` model, so it trains with the same `Trainer` as before. Only the LoRA weights need to be saved afterwards.
+
+# COMMAND ----------
+
+int8_trainer = Trainer(
+    model=int8_model,
+    args=training_args,
+    train_dataset=train_sample,
+    data_collator=transformers.DataCollatorForLanguageModeling(tokenizer, mlm=False)
+)
+int8_trainer.train()
+
+int8_lora_path = os.path.join(output_directory, f"int8_lora_{time.time()}.pt")
+torch.save({name: tensor for name, tensor in int8_model.state_dict().items() if "lora_" in name}, int8_lora_path)
+
+inputs = tokenizer("Two things are infinite: ", return_tensors="pt")
+int8_outputs = int8_model.generate(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"], max_new_tokens=7, eos_token_id=tokenizer.eos_token_id)
+print(tokenizer.batch_decode(int8_outputs, skip_special_tokens=True))
+
+# COMMAND ----------
+
 # MAGIC %md-sandbox
 # MAGIC &copy; 2023 Databricks, Inc. All rights reserved.<br/>
 # MAGIC Apache, Apache Spark, Spark and the Spark logo are trademarks of the <a href="https://www.apache.org/">Apache Software Foundation</a>.<br/>
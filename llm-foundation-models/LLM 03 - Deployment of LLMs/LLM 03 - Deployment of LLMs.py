@@ -29,6 +29,10 @@
 
 # COMMAND ----------
 
+# MAGIC %pip install onnx==1.14.1 onnxruntime==1.16.3
+
+# COMMAND ----------
+
 import numpy as np
 import matplotlib.pyplot as plt
 import torch
@@ -37,7 +41,6 @@ import torch.optim as optim
 import torchvision
 import torchvision.transforms as transforms
 from torch.utils.data import DataLoader
-import sys
 import io
 
 # COMMAND ----------
@@ -63,34 +66,34 @@ import io
 
 def quantize(value, bits):
     """
-    Quantizes a floating point number to an integer, given a certain number of bits.
+    Quantizes a floating point number, or an array of them, to integers, given a certain number of bits.
     The range is from -1.0 to 1.0.
     
     Args:
-    value (float): The value to be quantized.
+    value (float or np.ndarray): The value(s) to be quantized.
     bits (int): The number of bits used for quantization.
     
     Returns:
-    int: The quantized value.
+    int or np.ndarray: The quantized value(s).
     """
-    assert -1.0 <= value <= 1.0, "Value out of range"
-    quantized_value = np.round(value * (2**(bits - 1) - 1))
-    return int(quantized_value)
+    assert np.all(np.abs(value) <= 1.0), "Value out of range"
+    quantized_value = np.round(np.asarray(value) * (2**(bits - 1) - 1)).astype(np.int64)
+    return int(quantized_value) if quantized_value.ndim == 0 else quantized_value
 
 def unquantize(quantized_value, bits):
     """
-    Unquantizes an integer back to a floating point number, given the original number of bits.
+    Unquantizes an integer, or an array of them, back to floating point numbers, given the original number of bits.
     The range is from -1.0 to 1.0.
     
     Args:
-    quantized_value (int): The value to be unquantized.
+    quantized_value (int or np.ndarray): The value(s) to be unquantized.
     bits (int): The number of bits used for quantization.
     
     Returns:
-    float: The unquantized value.
+    float or np.ndarray: The unquantized value(s).
     """
-    value = quantized_value / (2**(bits - 1) - 1)
-    return float(value)
+    value = np.asarray(quantized_value) / (2**(bits - 1) - 1)
+    return float(value) if value.ndim == 0 else value
 
 # COMMAND ----------
 
@@ -123,12 +126,12 @@ print(f"Original Value: {value}\n----\n4-bit Quantization:{quantized_value_4bit}
 x = np.linspace(-1, 1, 100)
 y = np.sin(np.pi * x)
 
-# Quantize and unquantize values for 4 and 8 bits
-y_quantized_4bit = np.array([quantize(val, bits=4) for val in y])
-y_unquantized_4bit = np.array([unquantize(val, bits=4) for val in y_quantized_4bit])
+# Quantize and unquantize values for 4 and 8 bits. The functions work on whole arrays at once.
+y_quantized_4bit = quantize(y, bits=4)
+y_unquantized_4bit = unquantize(y_quantized_4bit, bits=4)
 
-y_quantized_8bit = np.array([quantize(val, bits=8) for val in y])
-y_unquantized_8bit = np.array([unquantize(val, bits=8) for val in y_quantized_8bit])
+y_quantized_8bit = quantize(y, bits=8)
+y_unquantized_8bit = unquantize(y_quantized_8bit, bits=8)
 
 # Calculate quantization loss for 4 and 8 bits
 loss_4bit = np.mean((y - y_unquantized_4bit)**2)
@@ -268,12 +271,119 @@ print("Finished Training")
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC #### Calibrating the model before converting it
+# MAGIC
+# MAGIC `torch.quantization.prepare` only inserts **observers** in the model. They record the range of the activations flowing through each layer, and `convert` turns those ranges into the scale and zero point of each quantized activation. If no data goes through the prepared model, the observers have nothing to measure and the activation ranges of the quantized model are meaningless. So between `prepare` and `convert`, we stream a few batches of training data through the model: this is **calibration**.
+# MAGIC
+# MAGIC How the observers summarize what they saw also matters:
+# MAGIC - `minmax` keeps the smallest and largest values seen, so a single outlier stretches the range and wastes precision for all the other values.
+# MAGIC - `histogram` (the default for the `onednn` backend) builds a histogram of the values and picks the range that minimizes the quantization error.
+# MAGIC - `percentile` clips the range to a high percentile of the values of each batch, averaged over batches, which ignores rare outliers.
+
+# COMMAND ----------
+
+import copy
+import time
+from torch.ao.quantization import MinMaxObserver, HistogramObserver, QConfig
+
+class PercentileObserver(MinMaxObserver):
+    """Observes the running average of a low and high percentile of the values, instead of their min and max."""
+    def __init__(self, percentile=99.99, **kwargs):
+        super(PercentileObserver, self).__init__(**kwargs)
+        self.percentile = percentile
+        self.register_buffer("num_batches", torch.tensor(0))
+
+    def forward(self, x_orig):
+        if x_orig.numel() == 0:
+            return x_orig
+        x = x_orig.detach().flatten().float()
+        # torch.quantile is limited to 16M elements, which is more than enough to estimate a percentile
+        if x.numel() > 2**24:
+            x = x[torch.randint(0, x.numel(), (2**24,))]
+        low, high = torch.quantile(x, torch.tensor([1 - self.percentile / 100, self.percentile / 100]))
+        n = self.num_batches.item()
+        self.min_val.copy_(low if n == 0 else (self.min_val * n + low) / (n + 1))
+        self.max_val.copy_(high if n == 0 else (self.max_val * n + high) / (n + 1))
+        self.num_batches += 1
+        return x_orig
+
+ACTIVATION_OBSERVERS = {
+    "minmax": MinMaxObserver.with_args(dtype=torch.quint8),
+    "histogram": HistogramObserver.with_args(dtype=torch.quint8),
+    "percentile": PercentileObserver.with_args(percentile=99.99, dtype=torch.quint8),
+}
+
+def get_calibration_qconfig(observer="histogram"):
+    """Returns the `onednn` quantization configuration, with the activation observer of our choice."""
+    default_qconfig = torch.ao.quantization.get_default_qconfig("onednn")
+    return QConfig(activation=ACTIVATION_OBSERVERS[observer], weight=default_qconfig.weight)
+
+def calibrate(model_prepared, data_loader, num_batches=32):
+    """Streams `num_batches` batches from `data_loader` through a prepared model, so that its observers can record activation ranges."""
+    model_prepared.eval()
+    with torch.no_grad():
+        for i, (inputs, _) in enumerate(data_loader):
+            if i >= num_batches:
+                break
+            model_prepared(inputs)
+    return model_prepared
+
+def quantize_static(model, data_loader, observer="histogram", num_calibration_batches=32):
+    """Returns a calibrated, statically quantized copy of `model`. The original model is left unchanged."""
+    model = copy.deepcopy(model).eval()
+    model.qconfig = get_calibration_qconfig(observer)
+    torch.quantization.prepare(model, inplace=True)
+    calibrate(model, data_loader, num_calibration_batches)
+    return torch.quantization.convert(model, inplace=True)
+
+def evaluate(model, data_loader):
+    """Returns the accuracy of `model` on `data_loader` and its mean latency per batch, in milliseconds."""
+    model.eval()
+    correct, total, elapsed = 0, 0, 0.0
+    with torch.no_grad():
+        for inputs, labels in data_loader:
+            start = time.perf_counter()
+            outputs = model(inputs)
+            elapsed += time.perf_counter() - start
+            correct += (outputs.argmax(dim=1) == labels).sum().item()
+            total += labels.size(0)
+    return {"accuracy": correct / total, "latency_ms_per_batch": 1000 * elapsed / len(data_loader)}
+
+# The held-out MNIST test set, to compare the models
+testset = torchvision.datasets.MNIST(root=DA.paths.working_dir, train=False, download=True, transform=transform)
+testloader = DataLoader(testset, batch_size=256, shuffle=False)
+
+num_calibration_batches = 32
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Let's compare the accuracy and latency of the `float32` model with the `int8` models calibrated with each observer.
+
+# COMMAND ----------
+
+import pandas as pd
+
+calibration_results = [{"model": "fp32", **evaluate(net, testloader)}]
+for observer in ACTIVATION_OBSERVERS:
+    net_int8 = quantize_static(net, trainloader, observer=observer, num_calibration_batches=num_calibration_batches)
+    calibration_results.append({"model": f"int8 ({observer})", **evaluate(net_int8, testloader)})
+
+display(pd.DataFrame(calibration_results))
+
+# COMMAND ----------
+
 # Specify quantization configuration
 net.qconfig = torch.ao.quantization.get_default_qconfig("onednn")
 
 # Prepare the model for static quantization. This inserts observers in the model that will observe activation tensors during calibration.
+net.eval()
 net_prepared = torch.quantization.prepare(net)
 
+# Calibrate the model: run some training batches through it, so that the observers can record the range of the activations.
+calibrate(net_prepared, trainloader, num_batches=num_calibration_batches)
+
 # Now we convert the model to a quantized version.
 net_quantized = torch.quantization.convert(net_prepared)
 
@@ -284,11 +394,11 @@ net_quantized = torch.quantization.convert(net_prepared)
 # Let's look at the sizes of these two models on disk and see how much we save by quantization
 buf = io.BytesIO()
 torch.save(net.state_dict(), buf)
-size_original = sys.getsizeof(buf.getvalue())
+size_original = buf.getbuffer().nbytes
 
 buf = io.BytesIO()
 torch.save(net_quantized.state_dict(), buf)
-size_quantized = sys.getsizeof(buf.getvalue())
+size_quantized = buf.getbuffer().nbytes
 
 print("Size of the original model: ", size_original)
 print("Size of the quantized model: ", size_quantized)
@@ -368,6 +478,1261 @@ print(f"Size of one weight in quantized model: {net_quantized.fc1.weight().eleme
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC # Section 2 - Quantizing Tensors
+# MAGIC
+# MAGIC The `quantize` function above assumes every value lies between -1 and 1 and uses a single, fixed scale. Real weights and activations have arbitrary ranges that vary from one layer (and one output channel) to the next, so practical quantization schemes compute the scale from the data itself:
+# MAGIC
+# MAGIC - **Granularity**: one scale for the whole tensor (`"tensor"`), one per output channel (`"channel"`), or one per group of `group_size` consecutive values (`"group"`). Finer granularity follows the data more closely, at the cost of storing more scales.
+# MAGIC - **Symmetric or asymmetric**: a symmetric scheme maps `[-max|x|, max|x|]` to the integer range, with zero mapped to zero. An asymmetric scheme maps `[min(x), max(x)]` instead, with a `zero_point`, which wastes fewer levels on skewed distributions such as post-ReLU activations.
+# MAGIC - **Bit width**: anything from 2 to 8 bits. Below 8 bits, several values are **packed** into each byte of `uint8` storage, otherwise a 4-bit tensor would take as much memory as an 8-bit one.
+# MAGIC
+# MAGIC The functions below quantize whole tensors at once with vectorized PyTorch operations, and report the mean squared error (MSE) and the signal-to-quantization-noise ratio (SQNR, in dB) of the round trip.
+
+# COMMAND ----------
+
+import math
+
+class QuantizedTensor:
+    """
+    A tensor quantized to `bits` bits, with its codes packed into uint8 storage.
+
+    Attributes:
+    packed (torch.Tensor): The packed unsigned codes.
+    scale, zero_point (torch.Tensor): The quantization parameters, one per tensor, channel or group.
+    shape (torch.Size): The shape of the original tensor.
+    """
+    def __init__(self, packed, scale, zero_point, bits, shape, granularity, group_size, axis, symmetric):
+        self.packed = packed
+        self.scale = scale
+        self.zero_point = zero_point
+        self.bits = bits
+        self.shape = shape
+        self.granularity = granularity
+        self.group_size = group_size
+        self.axis = axis
+        self.symmetric = symmetric
+
+    @property
+    def nbytes(self):
+        # The packed codes plus the quantization parameters
+        return sum(t.numel() * t.element_size() for t in [self.packed, self.scale, self.zero_point])
+
+    def dequantize(self):
+        codes = unpack_codes(self.packed, self.bits, math.prod(self.shape))
+        values = (codes.reshape(self.scale.shape[0], -1).to(torch.float32) - self.zero_point) * self.scale
+        return _from_rows(values, self.shape, self.granularity, self.axis)
+
+def _to_rows(x, granularity, group_size, axis):
+    # Reshapes x so that each row shares one scale and zero point
+    if granularity == "tensor":
+        return x.reshape(1, -1)
+    if granularity == "channel":
+        return x.movedim(axis, 0).reshape(x.shape[axis], -1)
+    if granularity == "group":
+        assert x.shape[-1] % group_size == 0, f"The last dimension ({x.shape[-1]}) must be a multiple of group_size ({group_size})"
+        return x.reshape(-1, group_size)
+    raise ValueError(f"Unknown granularity {granularity}, expected 'tensor', 'channel' or 'group'")
+
+def _from_rows(rows, shape, granularity, axis):
+    if granularity == "channel":
+        moved_shape = (shape[axis],) + tuple(s for i, s in enumerate(shape) if i != axis % len(shape))
+        return rows.reshape(moved_shape).movedim(0, axis)
+    return rows.reshape(shape)
+
+def pack_codes(codes, bits):
+    """Packs unsigned integer codes of `bits` bits each into a flat uint8 tensor."""
+    codes = codes.flatten().to(torch.uint8)
+    if 8 % bits == 0:
+        # Fast path: a whole number of codes fits in each byte
+        per_byte = 8 // bits
+        codes = torch.cat([codes, codes.new_zeros(-codes.numel() % per_byte)]).reshape(-1, per_byte)
+        shifts = torch.arange(0, 8, bits, dtype=torch.uint8)
+        return (codes << shifts).sum(dim=1, dtype=torch.uint8)
+    # General case: lay the codes out as a bit stream and cut it into bytes
+    bit_stream = ((codes.unsqueeze(1) >> torch.arange(bits, dtype=torch.uint8)) & 1).flatten()
+    bit_stream = torch.cat([bit_stream, bit_stream.new_zeros(-bit_stream.numel() % 8)]).reshape(-1, 8)
+    return (bit_stream << torch.arange(8, dtype=torch.uint8)).sum(dim=1, dtype=torch.uint8)
+
+def unpack_codes(packed, bits, numel):
+    """Inverse of `pack_codes`: returns the first `numel` codes stored in `packed`."""
+    mask = (1 << bits) - 1
+    if 8 % bits == 0:
+        shifts = torch.arange(0, 8, bits, dtype=torch.uint8)
+        return ((packed.unsqueeze(1) >> shifts) & mask).flatten()[:numel]
+    bit_stream = ((packed.unsqueeze(1) >> torch.arange(8, dtype=torch.uint8)) & 1).flatten()
+    bit_stream = bit_stream[:numel * bits].reshape(numel, bits)
+    return (bit_stream << torch.arange(bits, dtype=torch.uint8)).sum(dim=1, dtype=torch.uint8)
+
+def quantize_tensor(x, bits=8, granularity="tensor", group_size=128, axis=0, symmetric=True):
+    """
+    Quantizes a whole tensor (or NumPy array) to `bits` bits.
+
+    Args:
+    x (torch.Tensor or np.ndarray): The values to be quantized.
+    bits (int): The number of bits per value, from 2 to 8.
+    granularity (str): "tensor", "channel" (one scale per index along `axis`) or "group" (one scale per `group_size` values along the last dimension).
+    symmetric (bool): Whether to use a symmetric range around zero, or the asymmetric [min, max] range with a zero point.
+
+    Returns:
+    QuantizedTensor: The packed codes and the parameters needed to dequantize them.
+    """
+    assert 2 <= bits <= 8, "Only 2 to 8 bits are supported"
+    x = torch.as_tensor(x, dtype=torch.float32)
+    rows = _to_rows(x, granularity, group_size, axis)
+
+    if symmetric:
+        # Signed range [-qmax, qmax], shifted by qmax + 1 so that the stored codes are unsigned
+        qmax = 2 ** (bits - 1) - 1
+        scale = rows.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / qmax
+        zero_point = torch.full_like(scale, qmax + 1)
+    else:
+        qmax = 2 ** bits - 1
+        row_min = rows.amin(dim=1, keepdim=True).clamp(max=0)
+        row_max = rows.amax(dim=1, keepdim=True).clamp(min=0)
+        scale = (row_max - row_min).clamp(min=1e-12) / qmax
+        zero_point = torch.round(-row_min / scale)
+
+    codes = torch.clamp(torch.round(rows / scale) + zero_point, 0, 2 ** bits - 1)
+    return QuantizedTensor(pack_codes(codes, bits), scale, zero_point, bits, x.shape, granularity, group_size, axis, symmetric)
+
+def quantization_metrics(x, x_hat):
+    """Returns the mean squared error and the signal-to-quantization-noise ratio (in dB) of `x_hat` with respect to `x`."""
+    x, x_hat = torch.as_tensor(x, dtype=torch.float32), torch.as_tensor(x_hat, dtype=torch.float32)
+    mse = torch.mean((x - x_hat) ** 2).item()
+    sqnr_db = 10 * math.log10(torch.mean(x ** 2).item() / max(mse, 1e-20))
+    return {"mse": mse, "sqnr_db": sqnr_db}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Let's quantize the same sine curve as before, with a scale computed from the data this time.
+
+# COMMAND ----------
+
+for bits in [4, 8]:
+    y_quantized = quantize_tensor(y, bits=bits)
+    print(f"{bits}-bit: {quantization_metrics(y, y_quantized.dequantize())}")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC And now a million-element weight matrix, with outliers in a few channels as real layers often have. Per-channel and per-group scales keep the outliers of one channel from wasting the precision of all the others.
+
+# COMMAND ----------
+
+weight = torch.randn(1024, 1024) * 0.02
+weight[:, :8] *= 50  # a few outlier input features
+
+results = []
+for bits in [2, 3, 4, 8]:
+    for granularity in ["tensor", "channel", "group"]:
+        for symmetric in [True, False]:
+            start = time.perf_counter()
+            weight_quantized = quantize_tensor(weight, bits=bits, granularity=granularity, group_size=128, symmetric=symmetric)
+            quantize_ms = 1000 * (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            weight_dequantized = weight_quantized.dequantize()
+            dequantize_ms = 1000 * (time.perf_counter() - start)
+
+            results.append({"bits": bits,
+                            "granularity": granularity,
+                            "symmetric": symmetric,
+                            **quantization_metrics(weight, weight_dequantized),
+                            "compression": weight.numel() * weight.element_size() / weight_quantized.nbytes,
+                            "quantize_ms": quantize_ms,
+                            "dequantize_ms": dequantize_ms})
+
+import pandas as pd
+display(pd.DataFrame(results))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 3 - Quantization-Aware Training
+# MAGIC
+# MAGIC Post-training quantization rounds the weights and activations of a model that was trained without ever seeing that rounding, and there is nothing we can do afterwards to recover the accuracy it costs. **Quantization-aware training** (QAT) instead simulates the quantization during training with *fake-quant* modules: the forward pass rounds weights and activations exactly like the int8 model will, while the backward pass lets gradients flow through as if no rounding happened. The model learns weights that are robust to quantization.
+# MAGIC
+# MAGIC The QAT workflow in PyTorch is:
+# MAGIC 1. **Fuse** each `Linear` layer with the `ReLU` that follows it, so that they are quantized (and later executed) as a single operation, without an intermediate quantization step in between.
+# MAGIC 1. **Prepare** the model for QAT, which inserts fake-quant modules with observers.
+# MAGIC 1. **Train** as usual. After a few epochs, we **freeze the observers** so that the quantization ranges stop moving and the weights can settle into them.
+# MAGIC 1. **Convert** the model to a real int8 model.
+# MAGIC
+# MAGIC Fusion works on modules, so we use a version of `Net` whose ReLU is an `nn.ReLU` module rather than the `torch.relu` function. It has the same parameters, so we can start from the weights of the `net` we trained above.
+
+# COMMAND ----------
+
+class QATNet(Net):
+    def __init__(self):
+        super(QATNet, self).__init__()
+        self.relu = nn.ReLU()
+
+    def forward(self, x):
+        x = x.view(-1, 28 * 28)
+        x = self.quant(x)
+        x = self.relu(self.fc1(x))
+        x = self.fc2(x)
+        x = self.dequant(x)
+        return x
+
+def train_qat(model, data_loader, num_epochs=3, freeze_observers_after=2, lr=0.001):
+    """
+    Fine-tunes a fused model prepared for QAT, freezing its observers after `freeze_observers_after` epochs.
+    """
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.SGD(model.parameters(), lr=lr, momentum=0.9)
+    for epoch in range(num_epochs):
+        if epoch == freeze_observers_after:
+            # From now on, the quantization ranges stay fixed and only the weights keep learning
+            model.apply(torch.ao.quantization.disable_observer)
+        model.train()
+        running_loss = 0.0
+        for i, (inputs, labels) in enumerate(data_loader):
+            optimizer.zero_grad()
+            loss = criterion(model(inputs), labels)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item()
+            if i % 200 == 199:
+                print("[%d, %5d] loss: %.3f" % (epoch + 1, i + 1, running_loss / 200))
+                running_loss = 0.0
+    return model
+
+# COMMAND ----------
+
+# Start from the weights of the float model we trained above
+net_qat = QATNet()
+net_qat.load_state_dict(net.state_dict())
+
+# 1. Fuse fc1 and its ReLU, then 2. insert the fake-quant modules
+net_qat.train()
+net_qat.qconfig = torch.ao.quantization.get_default_qat_qconfig("onednn")
+net_qat = torch.ao.quantization.fuse_modules_qat(net_qat, [["fc1", "relu"]])
+net_qat = torch.ao.quantization.prepare_qat(net_qat)
+
+# 3. Train with simulated quantization
+qat_epochs = 3
+train_qat(net_qat, trainloader, num_epochs=qat_epochs, freeze_observers_after=2)
+
+# 4. Export a real int8 model
+net_qat.eval()
+net_qat_quantized = torch.ao.quantization.convert(net_qat)
+print(net_qat_quantized)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC The QAT model was trained for 3 more epochs than `net` and `net_quantized`, so comparing them directly would mix the effect of QAT with the effect of the extra training. For a fair baseline, we fine-tune a copy of the `float32` model for the same epochs with the same optimizer, and quantize it after training (PTQ) as well.
+
+# COMMAND ----------
+
+# The same schedule as QAT, without fake-quant modules (disabling the observers has no effect on a float model)
+net_finetuned = Net()
+net_finetuned.load_state_dict(net.state_dict())
+train_qat(net_finetuned, trainloader, num_epochs=qat_epochs, freeze_observers_after=2)
+net_finetuned_quantized = quantize_static(net_finetuned, trainloader, num_calibration_batches=num_calibration_batches)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Let's compare the accuracy and the inference throughput of the `float32` models, the post-training quantized models, and the QAT model on the test set. The QAT model should be compared with the fine-tuned rows, which got the same amount of training.
+
+# COMMAND ----------
+
+qat_results = []
+for name, model in [("fp32", net),
+                    ("int8 PTQ", net_quantized),
+                    (f"fp32 fine-tuned +{qat_epochs} epochs", net_finetuned),
+                    (f"int8 PTQ of fp32 fine-tuned +{qat_epochs} epochs", net_finetuned_quantized),
+                    (f"int8 QAT +{qat_epochs} epochs", net_qat_quantized)]:
+    metrics = evaluate(model, testloader)
+    metrics["images_per_s"] = testloader.batch_size / (metrics["latency_ms_per_batch"] / 1000)
+    qat_results.append({"model": name, **metrics})
+
+display(pd.DataFrame(qat_results))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 4 - Benchmarking Inference
+# MAGIC
+# MAGIC So far we compared the models with a rough size measure and the quantization error on a single random input. Deciding which model to deploy calls for more careful measurements:
+# MAGIC - **Serialized size**: the number of bytes of the saved `state_dict`.
+# MAGIC - **Tensor memory**: the bytes of the tensors the model holds in memory, packed quantized weights included.
+# MAGIC - **Resident memory**: how much the resident set size (RSS) of the process grows per loaded copy of the model, allocator overhead included. The growth for a single model of a few hundred KB would be lost in the noise of the memory allocator, so we deserialize many copies of its `state_dict` at once and divide by their number.
+# MAGIC - **Latency percentiles and throughput**: the mean latency hides the slow requests that users notice, so we report the 50th, 95th and 99th percentiles, for several batch sizes and numbers of CPU threads.
+# MAGIC - **Accuracy** on the held-out test set, since a faster model is only useful if it is still accurate.
+# MAGIC
+# MAGIC The harness below takes any number of models, so we can reuse it for the other variants we build in this notebook.
+
+# COMMAND ----------
+
+import gc
+import psutil
+
+def serialized_size_bytes(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.getbuffer().nbytes
+
+def tensor_bytes(value):
+    """Counts the bytes of all the tensors in a (possibly nested) state_dict value, including packed quantized weights."""
+    if isinstance(value, torch.Tensor):
+        if value.is_quantized:
+            return value.int_repr().numel() * value.element_size()
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_bytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(tensor_bytes(v) for v in value.values())
+    return 0
+
+def resident_bytes_per_copy(model, n_copies=100):
+    """The growth of the resident memory of the process per deserialized copy of the state_dict of `model`."""
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    gc.collect()
+    rss_before = psutil.Process().memory_info().rss
+    copies = []
+    for _ in range(n_copies):
+        buf.seek(0)
+        copies.append(torch.load(buf))
+    rss_after = psutil.Process().memory_info().rss
+    del copies
+    gc.collect()
+    return (rss_after - rss_before) / n_copies
+
+def measure_latencies(model, inputs, n_iters=50, n_warmup=5):
+    latencies = []
+    with torch.no_grad():
+        for i in range(n_warmup + n_iters):
+            start = time.perf_counter()
+            model(inputs)
+            if i >= n_warmup:
+                latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+def benchmark_models(models, make_input, batch_sizes=(1, 16, 64, 256), thread_counts=(1, 4), n_iters=50, eval_loader=None):
+    """
+    Benchmarks the size, memory, latency, throughput and accuracy of several models.
+
+    Args:
+    models (dict): Maps a name to each model to benchmark.
+    make_input (callable): Returns an input batch of the given batch size.
+    batch_sizes, thread_counts (tuple): The batch sizes and numbers of CPU threads to measure latency with.
+    eval_loader (DataLoader): An optional held-out set of (inputs, labels) batches to measure accuracy on.
+
+    Returns:
+    tuple: A DataFrame with one row per model, and a DataFrame with one row per model, thread count and batch size.
+    """
+    original_num_threads = torch.get_num_threads()
+    summary, latencies = [], []
+    for name, model in models.items():
+        model.eval()
+        row = {"model": name,
+               "serialized_mb": serialized_size_bytes(model) / 1e6,
+               "tensor_mb": tensor_bytes(model.state_dict()) / 1e6,
+               "resident_mb": resident_bytes_per_copy(model) / 1e6}
+        if eval_loader is not None:
+            row["accuracy"] = evaluate(model, eval_loader)["accuracy"]
+        summary.append(row)
+
+        for num_threads in thread_counts:
+            torch.set_num_threads(num_threads)
+            for batch_size in batch_sizes:
+                batch_latencies = measure_latencies(model, make_input(batch_size), n_iters=n_iters)
+                latencies.append({"model": name,
+                                  "threads": num_threads,
+                                  "batch_size": batch_size,
+                                  "p50_ms": 1000 * np.percentile(batch_latencies, 50),
+                                  "p95_ms": 1000 * np.percentile(batch_latencies, 95),
+                                  "p99_ms": 1000 * np.percentile(batch_latencies, 99),
+                                  "samples_per_s": batch_size / batch_latencies.mean()})
+    torch.set_num_threads(original_num_threads)
+    return pd.DataFrame(summary), pd.DataFrame(latencies)
+
+# COMMAND ----------
+
+# Real test images as inputs, so that the quantized models see realistic activations
+test_images = torch.stack([testset[i][0] for i in range(256)])
+
+def make_mnist_input(batch_size):
+    return test_images[:batch_size]
+
+summary_df, latency_df = benchmark_models({"net (fp32)": net,
+                                           "net_quantized (int8 PTQ)": net_quantized,
+                                           "net_qat_quantized (int8 QAT)": net_qat_quantized},
+                                          make_mnist_input,
+                                          eval_loader=testloader)
+display(summary_df)
+display(latency_df)
+
+# COMMAND ----------
+
+fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+for ax, num_threads in zip(axes, sorted(latency_df["threads"].unique())):
+    for name, group in latency_df[latency_df["threads"] == num_threads].groupby("model"):
+        ax.plot(group["batch_size"], group["samples_per_s"], marker="o", label=name)
+    ax.set_xscale("log")
+    ax.set_xlabel("Batch size")
+    ax.set_ylabel("Throughput (samples/s)")
+    ax.set_title(f"{num_threads} thread(s)")
+    ax.legend()
+plt.tight_layout()
+plt.show()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 5 - A Preprocessed MNIST Cache for Fast Epochs
+# MAGIC
+# MAGIC Our training loop spends a surprising share of each epoch outside the model: the `DataLoader` decodes every image into a PIL image, applies `ToTensor()` and `Normalize` one image at a time, and collates the results, all in a single process, again on every epoch. The output never changes, so we can do this work **once**:
+# MAGIC
+# MAGIC 1. Normalize the whole dataset in a single vectorized operation and write it to a `.npy` file.
+# MAGIC 1. Memory-map that file, so the operating system pages it in on demand and keeps it cached across epochs and notebooks.
+# MAGIC 1. Serve batches as slices of that array, which `torch.from_numpy` turns into tensors without copying. To shuffle, we draw one permutation per epoch and gather each batch with a single vectorized lookup of its (sorted) indices, instead of one Python-level lookup per image. Only the images of the current batch are read, so the whole dataset never has to fit in memory.
+
+# COMMAND ----------
+
+import os
+
+def build_mnist_cache(root, cache_dir, train=True, mean=0.1307, std=0.3081):
+    """
+    Normalizes MNIST once and writes it as memory-mappable `.npy` files. Does nothing if the cache already exists.
+
+    Returns:
+    tuple: The paths of the images file, of shape (N, 1, 28, 28) in float32, and of the labels file.
+    """
+    split = "train" if train else "test"
+    images_path = os.path.join(cache_dir, f"mnist_{split}_images.npy")
+    labels_path = os.path.join(cache_dir, f"mnist_{split}_labels.npy")
+    if os.path.exists(images_path) and os.path.exists(labels_path):
+        return images_path, labels_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    raw = torchvision.datasets.MNIST(root=root, train=train, download=True)
+    # Same result as ToTensor() followed by Normalize, for the whole dataset at once
+    images = ((raw.data.float() / 255.0 - mean) / std).unsqueeze(1)
+
+    images_memmap = np.lib.format.open_memmap(images_path, mode="w+", dtype=np.float32, shape=tuple(images.shape))
+    images_memmap[:] = images.numpy()
+    images_memmap.flush()
+    np.save(labels_path, raw.targets.numpy().astype(np.int64))
+    return images_path, labels_path
+
+class MemmapBatchLoader:
+    """
+    Serves (inputs, labels) batches from the memory-mapped MNIST cache, as a drop-in replacement for our DataLoader.
+
+    Args:
+    images_path, labels_path (str): The files written by `build_mnist_cache`.
+    batch_size (int): The number of images per batch.
+    shuffle (bool): Whether to visit the images in a new random order on every epoch.
+    """
+    def __init__(self, images_path, labels_path, batch_size=64, shuffle=True, seed=0):
+        # "c" (copy-on-write) gives writable arrays, which torch.from_numpy expects, without ever modifying the files
+        self.images = np.load(images_path, mmap_mode="c")
+        self.labels = np.load(labels_path)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = np.random.default_rng(seed)
+
+    def __len__(self):
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if not self.shuffle:
+            for start in range(0, len(self.labels), self.batch_size):
+                # Slices of a NumPy array are views, and torch.from_numpy shares their memory: no copy per batch
+                yield (torch.from_numpy(self.images[start:start + self.batch_size]),
+                       torch.from_numpy(self.labels[start:start + self.batch_size]))
+            return
+
+        permutation = self.generator.permutation(len(self.labels))
+        for start in range(0, len(self.labels), self.batch_size):
+            # Sorted indices read the memory map front to back. The order within a batch doesn't matter for training
+            indices = np.sort(permutation[start:start + self.batch_size])
+            # Fancy indexing gathers the batch into a new array, so a batch stays valid after the next one is served
+            yield torch.from_numpy(self.images[indices]), torch.from_numpy(self.labels[indices])
+
+# COMMAND ----------
+
+cache_dir = os.path.join(DA.paths.working_dir, "mnist_cache")
+train_images_path, train_labels_path = build_mnist_cache(DA.paths.working_dir, cache_dir, train=True)
+memmap_trainloader = MemmapBatchLoader(train_images_path, train_labels_path, batch_size=64, shuffle=True)
+
+# The cached images are exactly the ones the torchvision pipeline produces
+print(torch.allclose(torch.from_numpy(np.array(memmap_trainloader.images[0])), trainset[0][0], atol=1e-6))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Let's compare the time of one epoch with both data pipelines: first just iterating over the batches, then training a fresh `Net` for one epoch.
+
+# COMMAND ----------
+
+def train_one_epoch(model, data_loader):
+    optimizer = optim.SGD(model.parameters(), lr=0.01)
+    for inputs, labels in data_loader:
+        optimizer.zero_grad()
+        loss = criterion(model(inputs), labels)
+        loss.backward()
+        optimizer.step()
+
+epoch_results = []
+for name, data_loader in [("torchvision DataLoader", trainloader), ("memory-mapped cache", memmap_trainloader)]:
+    start = time.perf_counter()
+    for inputs, labels in data_loader:
+        pass
+    loading_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    train_one_epoch(Net(), data_loader)
+    training_s = time.perf_counter() - start
+
+    epoch_results.append({"pipeline": name, "loading_only_s": loading_s, "training_epoch_s": training_s})
+
+display(pd.DataFrame(epoch_results))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 6 - Structured Pruning
+# MAGIC
+# MAGIC Quantization shrinks every weight. **Pruning** removes weights altogether. Setting individual weights to zero (unstructured pruning) saves little on a CPU: the matrices keep their shape, and dense matrix multiplications don't skip zeros. **Structured pruning** removes whole neurons or attention heads instead, so the pruned layers can be rebuilt as *smaller dense matrices* that are faster with any kernel.
+# MAGIC
+# MAGIC Removing the hidden neuron `i` of a pair of linear layers means deleting row `i` of the first layer (and its bias) and column `i` of the second one. We rank the neurons by their **magnitude**: the norm of the weights coming into the neuron times the norm of the weights going out of it.
+
+# COMMAND ----------
+
+import torch.nn.functional as F
+from transformers import AutoTokenizer, BertModel
+
+def neuron_importance(fc_in, fc_out):
+    """The magnitude of each hidden neuron between two linear layers."""
+    return fc_in.weight.norm(dim=1) * fc_out.weight.norm(dim=0)
+
+def prune_linear_pair(fc_in, fc_out, sparsity):
+    """
+    Physically removes the least important hidden neurons between two linear layers.
+
+    Args:
+    fc_in, fc_out (nn.Linear): The layers before and after the hidden neurons.
+    sparsity (float): The fraction of hidden neurons to remove.
+
+    Returns:
+    tuple: The new, smaller (fc_in, fc_out) layers.
+    """
+    num_keep = max(1, round(fc_in.out_features * (1 - sparsity)))
+    keep = neuron_importance(fc_in, fc_out).topk(num_keep).indices.sort().values
+
+    new_fc_in = nn.Linear(fc_in.in_features, num_keep, bias=fc_in.bias is not None)
+    new_fc_out = nn.Linear(num_keep, fc_out.out_features, bias=fc_out.bias is not None)
+    with torch.no_grad():
+        new_fc_in.weight.copy_(fc_in.weight[keep])
+        if fc_in.bias is not None:
+            new_fc_in.bias.copy_(fc_in.bias[keep])
+        new_fc_out.weight.copy_(fc_out.weight[:, keep])
+        if fc_out.bias is not None:
+            new_fc_out.bias.copy_(fc_out.bias)
+    return new_fc_in, new_fc_out
+
+def prune_net(model, sparsity):
+    """Returns a copy of a `Net` with a fraction `sparsity` of its hidden neurons removed."""
+    pruned = copy.deepcopy(model)
+    pruned.fc1, pruned.fc2 = prune_linear_pair(model.fc1, model.fc2, sparsity)
+    return pruned
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Let's sweep the sparsity of `net`. Pruning a trained network costs some accuracy, most of which a short fine-tuning recovers, so we measure the accuracy both right after pruning and after one epoch of fine-tuning on the memory-mapped cache of Section 5.
+
+# COMMAND ----------
+
+def pruning_sweep(model, prune_function, sparsities, make_input, batch_size=64, eval_loader=None, finetune_loader=None):
+    """
+    Prunes `model` at each sparsity and measures its size, its CPU latency and, optionally, its accuracy before and after fine-tuning.
+
+    Returns:
+    DataFrame: One row per sparsity.
+    """
+    inputs = make_input(batch_size)
+    rows = []
+    for sparsity in sparsities:
+        pruned = prune_function(model, sparsity).eval()
+        row = {"sparsity": sparsity,
+               "parameters": count_parameters(pruned),
+               "p50_ms": 1000 * np.percentile(measure_latencies(pruned, inputs), 50)}
+        if eval_loader is not None:
+            row["accuracy"] = evaluate(pruned, eval_loader)["accuracy"]
+            if finetune_loader is not None:
+                pruned.train()
+                train_one_epoch(pruned, finetune_loader)
+                row["accuracy_finetuned"] = evaluate(pruned.eval(), eval_loader)["accuracy"]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+sparsities = [0.0, 0.25, 0.5, 0.75, 0.875, 0.9375]
+net_pruning_df = pruning_sweep(net, prune_net, sparsities, make_mnist_input, batch_size=256,
+                               eval_loader=testloader, finetune_loader=memmap_trainloader)
+display(net_pruning_df)
+
+# COMMAND ----------
+
+def plot_pruning_sweep(df, quality_columns, title):
+    fig, ax_quality = plt.subplots(figsize=(8, 5))
+    for column in quality_columns:
+        ax_quality.plot(df["sparsity"], df[column], marker="o", label=column)
+    ax_quality.set_xlabel("Sparsity (fraction of neurons removed)")
+    ax_quality.set_ylabel(" / ".join(quality_columns))
+    ax_quality.legend(loc="lower left")
+
+    # Latency on a second y-axis
+    ax_latency = ax_quality.twinx()
+    ax_latency.plot(df["sparsity"], df["p50_ms"], marker="s", color="gray", linestyle="--", label="p50 latency")
+    ax_latency.set_ylabel("CPU latency (ms)")
+    ax_latency.legend(loc="lower right")
+    ax_quality.set_title(title)
+    plt.show()
+
+plot_pruning_sweep(net_pruning_df, ["accuracy", "accuracy_finetuned"], "Net: sparsity vs. accuracy vs. latency")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Pruning a Transformer
+# MAGIC
+# MAGIC The same idea applies to the two kinds of structures in a transformer layer:
+# MAGIC - The **feed-forward block** is a pair of linear layers (768 → 3072 → 768 in BERT-base), so we can remove its intermediate neurons with `prune_linear_pair`.
+# MAGIC - **Attention heads** each own a slice of the query, key and value projections and of the output projection. Hugging Face's `prune_heads` physically removes those slices. We rank the heads by the norm of their value projection times the norm of their slice of the output projection, and always keep at least one head per layer.
+# MAGIC
+# MAGIC There is no task to measure an accuracy on with the pretrained BERT, so we measure how closely the pruned model reproduces the hidden states of the original one instead.
+
+# COMMAND ----------
+
+def head_importance(attention):
+    """The magnitude of each head of a BertAttention module."""
+    num_heads = attention.self.num_attention_heads
+    head_size = attention.self.attention_head_size
+    value_norm = attention.self.value.weight.view(num_heads, head_size, -1).norm(dim=(1, 2))
+    output_norm = attention.output.dense.weight.view(-1, num_heads, head_size).norm(dim=(0, 2))
+    return value_norm * output_norm
+
+def prune_transformer(model, ffn_sparsity=0.5, head_sparsity=0.0):
+    """
+    Returns a copy of a BERT model with a fraction of the feed-forward neurons and attention heads of every layer physically removed.
+    """
+    pruned = copy.deepcopy(model)
+    heads_to_prune = {}
+    for i, layer in enumerate(pruned.encoder.layer):
+        if ffn_sparsity > 0:
+            layer.intermediate.dense, layer.output.dense = prune_linear_pair(layer.intermediate.dense, layer.output.dense, ffn_sparsity)
+        num_heads = layer.attention.self.num_attention_heads
+        num_prune = min(num_heads - 1, round(num_heads * head_sparsity))
+        if num_prune > 0:
+            heads_to_prune[i] = head_importance(layer.attention).topk(num_prune, largest=False).indices.tolist()
+    if heads_to_prune:
+        pruned.prune_heads(heads_to_prune)
+    return pruned
+
+bert_tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased", cache_dir=DA.paths.datasets+"/models")
+bert = BertModel.from_pretrained("bert-base-uncased", cache_dir=DA.paths.datasets+"/models").eval()
+
+bert_sentences = ["Quantization and pruning make models smaller and faster.",
+                  "The quick brown fox jumps over the lazy dog.",
+                  "Structured pruning removes whole neurons and attention heads.",
+                  "Deploying large language models on CPUs requires careful optimization."] * 2
+bert_inputs = bert_tokenizer(bert_sentences, padding="max_length", max_length=128, return_tensors="pt")
+with torch.no_grad():
+    bert_reference = bert(**bert_inputs).last_hidden_state
+
+def prune_bert(model, sparsity):
+    # The same fraction of feed-forward neurons and attention heads
+    return prune_transformer(model, ffn_sparsity=sparsity, head_sparsity=sparsity)
+
+bert_rows = []
+for sparsity in [0.0, 0.25, 0.5, 0.75]:
+    pruned_bert = prune_bert(bert, sparsity).eval()
+    with torch.no_grad():
+        hidden_states = pruned_bert(**bert_inputs).last_hidden_state
+    latencies = measure_latencies(lambda inputs: pruned_bert(**inputs), bert_inputs, n_iters=10, n_warmup=2)
+    bert_rows.append({"sparsity": sparsity,
+                      "parameters": count_parameters(pruned_bert),
+                      "p50_ms": 1000 * np.percentile(latencies, 50),
+                      "cosine_similarity": F.cosine_similarity(hidden_states, bert_reference, dim=-1).mean().item()})
+bert_pruning_df = pd.DataFrame(bert_rows)
+display(bert_pruning_df)
+plot_pruning_sweep(bert_pruning_df, ["cosine_similarity"], "BERT: sparsity vs. fidelity vs. latency")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 7 - Exporting to ONNX and Running with ONNX Runtime
+# MAGIC
+# MAGIC So far every model runs through eager PyTorch, which dispatches each operator from Python. [ONNX](https://onnx.ai/) is a portable format for the computation graph of a model, and [ONNX Runtime](https://onnxruntime.ai/) executes that graph after optimizing it (fusing operators, folding constants) with kernels tuned for the CPU. It also ships its own int8 quantization:
+# MAGIC - **Dynamic quantization** stores the weights as int8 and quantizes the activations on the fly.
+# MAGIC - **Static quantization** also fixes the activation ranges, from calibration batches, like `net_quantized`.
+# MAGIC
+# MAGIC PyTorch's eager-mode quantized operators (like those of `net_quantized`) don't export cleanly to ONNX, so the int8 ONNX variants are built from the fp32 export with ONNX Runtime's quantizer instead.
+# MAGIC
+# MAGIC `OnnxRuntimeModel` wraps an inference session behind the same call interface as the PyTorch model it was exported from: it takes and returns tensors. The benchmark code from Section 4 works on it unchanged, and we can pick the fastest runtime for each model.
+
+# COMMAND ----------
+
+import itertools
+import onnxruntime as ort
+# Imported as a module, so that its quantize_static doesn't shadow the one defined in Section 1
+import onnxruntime.quantization as ortq
+
+def export_onnx(model, example_inputs, path, input_names, output_names, dynamic_axes=None, opset_version=17):
+    """
+    Exports `model` to ONNX by tracing it on `example_inputs`.
+
+    Args:
+    example_inputs (tuple): The positional inputs of the model.
+    input_names, output_names (list): The names of the inputs and outputs of the graph.
+    dynamic_axes (dict): The dimensions of each input and output which may change between calls, like the batch size.
+    """
+    model.eval()
+    torch.onnx.export(model, example_inputs, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset_version)
+    return path
+
+class OnnxRuntimeModel:
+    """
+    Runs an ONNX model with ONNX Runtime on the CPU, with the call interface of a PyTorch model.
+
+    Args:
+    path (str): The path of the .onnx file.
+    num_threads (int): The intra-op threads of the session. Defaults to ONNX Runtime's choice.
+    """
+    def __init__(self, path, num_threads=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+    def __call__(self, *args, **kwargs):
+        feed = dict(zip(self.input_names, args))
+        feed.update({name: kwargs[name] for name in self.input_names if name in kwargs})
+        feed = {name: value.detach().cpu().numpy() if torch.is_tensor(value) else value for name, value in feed.items()}
+        outputs = [torch.from_numpy(output) for output in self.session.run(self.output_names, feed)]
+        return outputs[0] if len(outputs) == 1 else dict(zip(self.output_names, outputs))
+
+    def eval(self):
+        # Only for compatibility with the helpers written for PyTorch models
+        return self
+
+class BatchCalibrationReader(ortq.CalibrationDataReader):
+    """Feeds calibration batches to ONNX Runtime's static quantizer."""
+    def __init__(self, input_name, batches):
+        self.batches = iter([{input_name: batch.numpy()} for batch in batches])
+
+    def get_next(self):
+        return next(self.batches, None)
+
+def quantize_onnx(path, mode="dynamic", input_name=None, calibration_batches=None):
+    """Writes an int8 version of an fp32 ONNX model next to it, and returns its path."""
+    quantized_path = path.replace(".onnx", f"_int8_{mode}.onnx")
+    if mode == "dynamic":
+        ortq.quantize_dynamic(path, quantized_path, weight_type=ortq.QuantType.QInt8)
+    else:
+        ortq.quantize_static(path, quantized_path, BatchCalibrationReader(input_name, calibration_batches),
+                             activation_type=ortq.QuantType.QUInt8, weight_type=ortq.QuantType.QInt8)
+    return quantized_path
+
+def check_parity(reference, candidate, inputs, atol):
+    """Compares the outputs of two models on the same inputs."""
+    with torch.no_grad():
+        expected, actual = reference(inputs), candidate(inputs)
+    max_abs_diff = (expected - actual).abs().max().item()
+    return {"max_abs_diff": max_abs_diff,
+            "argmax_agreement": (expected.argmax(-1) == actual.argmax(-1)).float().mean().item(),
+            "passed": max_abs_diff <= atol}
+
+# COMMAND ----------
+
+onnx_dir = os.path.join(DA.paths.working_dir, "onnx")
+os.makedirs(onnx_dir, exist_ok=True)
+
+# The QuantStub and DeQuantStub of an unprepared Net are identities, so the fp32 net exports as a plain graph
+net_onnx_path = export_onnx(net, (test_images[:1],), os.path.join(onnx_dir, "net.onnx"),
+                            input_names=["pixels"], output_names=["logits"],
+                            dynamic_axes={"pixels": {0: "batch"}, "logits": {0: "batch"}})
+# Calibrate on training batches, like net_quantized, and keep the test set for the evaluation
+calibration_batches = [images for images, _ in itertools.islice(iter(trainloader), 8)]
+mnist_runtimes = {
+    "net (PyTorch fp32)": net,
+    "net_quantized (PyTorch int8)": net_quantized,
+    "net (ONNX Runtime fp32)": OnnxRuntimeModel(net_onnx_path),
+    "net (ONNX Runtime int8 dynamic)": OnnxRuntimeModel(quantize_onnx(net_onnx_path, "dynamic")),
+    "net (ONNX Runtime int8 static)": OnnxRuntimeModel(quantize_onnx(net_onnx_path, "static", "pixels", calibration_batches)),
+}
+
+# fp32 ONNX Runtime must match PyTorch up to float rounding, the int8 variants up to quantization error
+parity_results = []
+for name, model in mnist_runtimes.items():
+    atol = 1e-4 if "fp32" in name else 1.0
+    parity_results.append({"model": name, **check_parity(net, model, test_images, atol)})
+display(pd.DataFrame(parity_results))
+
+# COMMAND ----------
+
+def compare_runtimes(models, make_input, batch_sizes=(1, 64, 256), n_iters=50):
+    """Measures the p50 latency of each runtime, and returns the fastest one for each batch size."""
+    rows = []
+    for name, model in models.items():
+        for batch_size in batch_sizes:
+            latencies = measure_latencies(model, make_input(batch_size), n_iters=n_iters)
+            rows.append({"model": name, "batch_size": batch_size, "p50_ms": 1000 * np.percentile(latencies, 50)})
+    runtime_df = pd.DataFrame(rows)
+    fastest = runtime_df.loc[runtime_df.groupby("batch_size")["p50_ms"].idxmin()]
+    return runtime_df, fastest
+
+mnist_runtime_df, mnist_fastest = compare_runtimes(mnist_runtimes, make_mnist_input)
+display(mnist_runtime_df.pivot(index="model", columns="batch_size", values="p50_ms"))
+display(mnist_fastest)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC The same path works for the transformer experts of the MoE lab. Here we export the BERT encoder loaded in Section 6 with dynamic batch and sequence dimensions. The ONNX graph only returns the last hidden state, so we compare it against a thin wrapper of the PyTorch model that does the same.
+
+# COMMAND ----------
+
+class LastHiddenState(nn.Module):
+    def __init__(self, model):
+        super(LastHiddenState, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+bert_pytorch = LastHiddenState(bert).eval()
+bert_onnx_path = export_onnx(bert_pytorch, (bert_inputs["input_ids"], bert_inputs["attention_mask"]),
+                             os.path.join(onnx_dir, "bert.onnx"),
+                             input_names=["input_ids", "attention_mask"], output_names=["last_hidden_state"],
+                             dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                           "attention_mask": {0: "batch", 1: "sequence"},
+                                           "last_hidden_state": {0: "batch", 1: "sequence"}})
+bert_runtimes = {
+    "bert (PyTorch fp32)": bert_pytorch,
+    "bert (ONNX Runtime fp32)": OnnxRuntimeModel(bert_onnx_path),
+    "bert (ONNX Runtime int8 dynamic)": OnnxRuntimeModel(quantize_onnx(bert_onnx_path, "dynamic")),
+}
+
+bert_runtime_rows = []
+with torch.no_grad():
+    reference = bert_pytorch(bert_inputs["input_ids"], bert_inputs["attention_mask"])
+for name, model in bert_runtimes.items():
+    with torch.no_grad():
+        hidden_states = model(bert_inputs["input_ids"], bert_inputs["attention_mask"])
+    latencies = measure_latencies(lambda inputs: model(inputs["input_ids"], inputs["attention_mask"]), bert_inputs, n_iters=10, n_warmup=2)
+    bert_runtime_rows.append({"model": name,
+                              "max_abs_diff": (hidden_states - reference).abs().max().item(),
+                              "cosine_similarity": F.cosine_similarity(hidden_states, reference, dim=-1).mean().item(),
+                              "p50_ms": 1000 * np.percentile(latencies, 50)})
+display(pd.DataFrame(bert_runtime_rows))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 8 - Per-Layer Sensitivity and Mixed-Precision Quantization
+# MAGIC
+# MAGIC Quantizing every layer to the same number of bits treats all layers alike, but some layers barely notice 3-bit weights while others break at 4 bits. A **sensitivity analysis** finds out which is which: we quantize one layer at a time, at several bit widths, leaving the rest of the model in full precision, and measure how much a loss on a calibration set degrades.
+# MAGIC
+# MAGIC Assuming the degradations of different layers roughly add up, choosing one bit width per layer under a memory budget is a *multiple-choice knapsack* problem: minimize the total degradation such that the total size of the quantized weights fits the budget. We solve it exactly with dynamic programming over the budget, discretized into small units.
+# MAGIC
+# MAGIC The weights are quantized with `quantize_tensor` from Section 2 (per output channel, symmetric) and immediately dequantized ("fake quantization"), so the models keep running in float32 while seeing exactly the values an int kernel would.
+
+# COMMAND ----------
+
+from collections import Counter
+from contextlib import contextmanager
+from transformers import GPT2LMHeadModel, GPT2TokenizerFast
+from transformers.pytorch_utils import Conv1D
+
+def quantizable_layers(model):
+    """
+    Returns {name: module} for the Linear layers of a model, and the Conv1D layers of GPT-2.
+
+    Layers whose weight is tied to another module are skipped, like GPT-2's lm_head, which shares its weight with the token
+    embeddings: quantizing it would quantize the embeddings too, and its bytes would be counted twice.
+    """
+    owners = Counter(id(param) for module in model.modules() for param in module.parameters(recurse=False))
+    return {name: module for name, module in model.named_modules()
+            if isinstance(module, (nn.Linear, Conv1D)) and owners[id(module.weight)] == 1}
+
+def quantize_layer_weight(module, bits):
+    # nn.Linear stores its weight as (out_features, in_features), Conv1D as (in_features, out_features)
+    axis = 1 if isinstance(module, Conv1D) else 0
+    return quantize_tensor(module.weight.detach(), bits=bits, granularity="channel", axis=axis)
+
+@contextmanager
+def fake_quantized(layers, bits):
+    """Temporarily replaces the weights of `layers` ({name: module}) with their `bits`-bit round trip."""
+    originals = {name: module.weight.data for name, module in layers.items()}
+    try:
+        for name, module in layers.items():
+            module.weight.data = quantize_layer_weight(module, bits).dequantize().reshape(originals[name].shape)
+        yield
+    finally:
+        for name, module in layers.items():
+            module.weight.data = originals[name]
+
+def layer_sensitivity(model, loss_function, bit_widths=(3, 4, 8), layers=None):
+    """
+    Quantizes each layer on its own at each bit width and measures the increase of `loss_function(model)`.
+
+    Returns:
+    DataFrame: One row per layer and bit width, with the increase of the loss and the size of the quantized weight.
+    """
+    layers = layers or quantizable_layers(model)
+    model.eval()
+    baseline = loss_function(model)
+    rows = []
+    for name, module in layers.items():
+        for bits in bit_widths:
+            with fake_quantized({name: module}, bits):
+                loss = loss_function(model)
+            rows.append({"layer": name, "bits": bits,
+                         "degradation": max(loss - baseline, 0.0),
+                         "bytes": quantize_layer_weight(module, bits).nbytes})
+    return pd.DataFrame(rows)
+
+def allocate_bits(sensitivity_df, memory_budget_bytes, resolution=2000):
+    """
+    Chooses one bit width per layer to minimize the total degradation within the memory budget.
+
+    The sizes are rounded up to units of `memory_budget_bytes / resolution`, so the allocation always fits the budget.
+
+    Returns:
+    dict: {layer: bits}, or None if even the smallest bit widths don't fit.
+    """
+    unit = memory_budget_bytes / resolution
+    layers = list(dict.fromkeys(sensitivity_df["layer"]))
+    # best[c] is the smallest total degradation of the layers so far using at most c units
+    best = np.zeros(resolution + 1)
+    choices = []
+    for layer in layers:
+        options = sensitivity_df[sensitivity_df["layer"] == layer]
+        new_best = np.full(resolution + 1, np.inf)
+        choice = np.full(resolution + 1, -1)
+        for bits, degradation, size in zip(options["bits"], options["degradation"], options["bytes"]):
+            units = int(math.ceil(size / unit))
+            if units > resolution:
+                continue
+            candidate = np.full(resolution + 1, np.inf)
+            candidate[units:] = best[:resolution + 1 - units] + degradation
+            better = candidate < new_best
+            new_best[better] = candidate[better]
+            choice[better] = bits
+        best = new_best
+        choices.append(choice)
+    if not np.isfinite(best[-1]):
+        return None
+
+    # Walk back from the full budget to recover the bit width of every layer
+    allocation, capacity = {}, resolution
+    for layer, choice in zip(reversed(layers), reversed(choices)):
+        bits = int(choice[capacity])
+        allocation[layer] = bits
+        size = sensitivity_df[(sensitivity_df["layer"] == layer) & (sensitivity_df["bits"] == bits)]["bytes"].item()
+        capacity -= int(math.ceil(size / unit))
+    return dict(reversed(allocation.items()))
+
+def apply_bit_allocation(model, allocation):
+    """Returns a copy of `model` whose layers are fake-quantized to the bit widths of `allocation`."""
+    quantized = copy.deepcopy(model)
+    layers = quantizable_layers(quantized)
+    with torch.no_grad():
+        for name, bits in allocation.items():
+            module = layers[name]
+            module.weight.data = quantize_layer_weight(module, bits).dequantize().reshape(module.weight.shape)
+    return quantized
+
+def compare_allocations(model, sensitivity_df, loss_function, budget_fractions=(0.2, 0.25, 0.3)):
+    """Compares the mixed-precision allocations with uniform bit widths, at budgets given as fractions of the float32 weights."""
+    layers = quantizable_layers(model)
+    fp32_bytes = sum(module.weight.numel() * 4 for module in layers.values())
+    rows = []
+    for bits in sorted(sensitivity_df["bits"].unique()):
+        uniform = {name: int(bits) for name in layers}
+        rows.append({"allocation": f"uniform {bits}-bit",
+                     "weight_mb": sensitivity_df[sensitivity_df["bits"] == bits]["bytes"].sum() / 1e6,
+                     "loss": loss_function(apply_bit_allocation(model, uniform).eval())})
+    for fraction in budget_fractions:
+        allocation = allocate_bits(sensitivity_df, fraction * fp32_bytes)
+        if allocation is None:
+            continue
+        sizes = [sensitivity_df[(sensitivity_df["layer"] == name) & (sensitivity_df["bits"] == bits)]["bytes"].item()
+                 for name, bits in allocation.items()]
+        rows.append({"allocation": f"mixed, budget {fraction:.0%} of fp32",
+                     "weight_mb": sum(sizes) / 1e6,
+                     "loss": loss_function(apply_bit_allocation(model, allocation).eval()),
+                     "bits": pd.Series(allocation.values()).value_counts().sort_index().to_dict()})
+    return pd.DataFrame(rows)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Net
+# MAGIC
+# MAGIC For `net`, the loss is the cross-entropy on a few training batches.
+
+# COMMAND ----------
+
+net_calibration_batches = list(itertools.islice(iter(trainloader), 8))
+
+def net_loss(model):
+    with torch.no_grad():
+        return np.mean([criterion(model(images), labels).item() for images, labels in net_calibration_batches])
+
+net_sensitivity = layer_sensitivity(net, net_loss, bit_widths=(2, 3, 4, 8))
+display(net_sensitivity.pivot(index="layer", columns="bits", values="degradation"))
+display(compare_allocations(net, net_sensitivity, net_loss))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### GPT-2 and BERT
+# MAGIC
+# MAGIC For GPT-2 (small), the loss is the log-perplexity on a few calibration sentences. For the BERT encoder of Section 6, which has no language modeling head, it is the mean squared error of the last hidden state with respect to the float32 model.
+
+# COMMAND ----------
+
+calibration_texts = bert_sentences[:4] + [
+    "The committee will publish its final report early next year.",
+    "She opened the window and let the cold morning air into the room.",
+    "Prices rose sharply after the announcement of the new tariffs.",
+    "The recipe calls for two cups of flour and a pinch of salt.",
+]
+
+gpt2_small_tokenizer = GPT2TokenizerFast.from_pretrained("gpt2", cache_dir=DA.paths.datasets+"/models")
+gpt2_small = GPT2LMHeadModel.from_pretrained("gpt2", cache_dir=DA.paths.datasets+"/models").eval()
+gpt2_calibration_inputs = [gpt2_small_tokenizer(text, return_tensors="pt") for text in calibration_texts]
+
+def gpt2_loss(model):
+    # Mean negative log-likelihood per token, i.e. the log of the perplexity
+    with torch.no_grad():
+        return np.mean([model(**inputs, labels=inputs["input_ids"]).loss.item() for inputs in gpt2_calibration_inputs])
+
+gpt2_sensitivity = layer_sensitivity(gpt2_small, gpt2_loss, bit_widths=(3, 4, 8))
+gpt2_allocations = compare_allocations(gpt2_small, gpt2_sensitivity, gpt2_loss)
+gpt2_allocations["perplexity"] = np.exp(gpt2_allocations["loss"])
+display(gpt2_allocations)
+
+# COMMAND ----------
+
+bert_calibration_inputs = bert_tokenizer(calibration_texts, padding=True, return_tensors="pt")
+with torch.no_grad():
+    bert_calibration_reference = bert(**bert_calibration_inputs).last_hidden_state
+
+def bert_loss(model):
+    with torch.no_grad():
+        return F.mse_loss(model(**bert_calibration_inputs).last_hidden_state, bert_calibration_reference).item()
+
+bert_sensitivity = layer_sensitivity(bert, bert_loss, bit_widths=(3, 4, 8))
+display(compare_allocations(bert, bert_sensitivity, bert_loss))
+
+# COMMAND ----------
+
+# The most and least sensitive layers of GPT-2 at 3 bits
+gpt2_3bit = gpt2_sensitivity[gpt2_sensitivity["bits"] == 3].sort_values("degradation")
+fig, ax = plt.subplots(figsize=(12, 5))
+ax.bar(range(len(gpt2_3bit)), gpt2_3bit["degradation"])
+ax.set_xticks(range(len(gpt2_3bit)))
+ax.set_xticklabels(gpt2_3bit["layer"], rotation=90, fontsize=6)
+ax.set_ylabel("Increase of the log-perplexity")
+ax.set_title("GPT-2: sensitivity of each layer quantized alone to 3 bits")
+plt.tight_layout()
+plt.show()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 9 - Weight-Only 4-bit Quantization of Large Models
+# MAGIC
+# MAGIC For large language models running on a CPU, the weights dominate both the memory footprint and the time spent moving data, while the activations of a few tokens are tiny. **Weight-only** quantization keeps the activations in float32 and stores only the weights in 4 bits:
+# MAGIC - Each row of a weight matrix is split into groups of 128 values that share one float16 scale. Small groups keep the outliers of one group from wasting the precision of the others, and cost only 16 / 128 = 0.125 extra bits per weight.
+# MAGIC - Two 4-bit codes are packed into each byte (with `pack_codes` from Section 2), so a weight takes 4.125 bits instead of 32: almost 8x smaller.
+# MAGIC - At inference, `Int4Linear` dequantizes the weight on the fly, one block of output rows at a time, right before multiplying it with the input. The float32 weight is never materialized whole.
+# MAGIC
+# MAGIC The embeddings and layer norms stay in float32, so for GPT-2 XL the whole model shrinks by about 6x. `gpt2_loss` from Section 8 works unchanged, since all GPT-2 sizes share the same tokenizer.
+# MAGIC
+# MAGIC Quantizing GPT-2 XL requires loading its 6 GB of float32 weights first. We only want to do that once, so we save the quantized model to a checkpoint, and load that checkpoint directly into an empty model afterwards. The size and perplexity of the float32 model are measured during that first run and saved next to the checkpoint, so later runs never load the float32 weights.
+
+# COMMAND ----------
+
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from transformers import AutoConfig, AutoModelForCausalLM
+
+class Int4Linear(nn.Module):
+    """
+    A linear layer with 4-bit group-quantized weights, dequantized on the fly in blocks of output rows.
+
+    Args:
+    in_features, out_features (int): The shape of the layer, like nn.Linear.
+    bias (bool): Whether the layer has a (float32) bias.
+    group_size (int): The number of consecutive input features sharing a scale. The rows are zero-padded to a multiple of it.
+    block_size (int): The number of output rows dequantized at a time.
+    """
+    def __init__(self, in_features, out_features, bias=True, group_size=128, block_size=1024):
+        super(Int4Linear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        self.block_size = block_size
+        # GPT-2 XL has 1600 input features, which is 12.5 groups of 128
+        self.padded_in_features = math.ceil(in_features / group_size) * group_size
+        self.register_buffer("packed", torch.zeros(out_features, self.padded_in_features // 2, dtype=torch.uint8))
+        self.register_buffer("scales", torch.zeros(out_features, self.padded_in_features // group_size, dtype=torch.float16))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_float(cls, module, group_size=128):
+        """Quantizes an nn.Linear, or a GPT-2 Conv1D (whose weight is stored transposed)."""
+        weight = module.weight.detach().float()
+        if isinstance(module, Conv1D):
+            weight = weight.t()
+        out_features, in_features = weight.shape
+        int4_linear = cls(in_features, out_features, bias=module.bias is not None, group_size=group_size)
+        weight = F.pad(weight, (0, int4_linear.padded_in_features - in_features))
+        # Symmetric 4-bit codes in [1, 15], with an implicit zero point of 8
+        quantized = quantize_tensor(weight, bits=4, granularity="group", group_size=group_size, symmetric=True)
+        int4_linear.packed.copy_(quantized.packed.reshape(out_features, -1))
+        int4_linear.scales.copy_(quantized.scale.reshape(out_features, -1))
+        if module.bias is not None:
+            int4_linear.bias.copy_(module.bias.detach())
+        return int4_linear
+
+    def dequantize_rows(self, start, end):
+        # Unpack the low and high nibbles of every byte, in the order of pack_codes
+        packed = self.packed[start:end]
+        codes = torch.stack([packed & 0x0F, packed >> 4], dim=-1).reshape(end - start, -1, self.group_size)
+        weight = (codes.to(torch.float32) - 8) * self.scales[start:end].to(torch.float32).unsqueeze(-1)
+        return weight.reshape(end - start, self.padded_in_features)[:, :self.in_features]
+
+    def forward(self, x):
+        outputs = [x @ self.dequantize_rows(start, min(start + self.block_size, self.out_features)).t()
+                   for start in range(0, self.out_features, self.block_size)]
+        output = torch.cat(outputs, dim=-1)
+        return output + self.bias if self.bias is not None else output
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+def _set_submodule(model, name, module):
+    parent_name, _, child_name = name.rpartition(".")
+    setattr(model.get_submodule(parent_name) if parent_name else model, child_name, module)
+
+def quantize_model_int4(model, group_size=128, skip=("lm_head",)):
+    """
+    Replaces the Linear and Conv1D layers of `model` with Int4Linear layers, in place.
+
+    The layers in `skip` are kept. Layers with tied weights, like GPT-2's lm_head, are always kept (see `quantizable_layers`).
+
+    Returns:
+    list: The names of the quantized layers.
+    """
+    quantized_names = []
+    for name, module in list(quantizable_layers(model).items()):
+        if name.split(".")[-1] in skip:
+            continue
+        _set_submodule(model, name, Int4Linear.from_float(module, group_size))
+        quantized_names.append(name)
+    return quantized_names
+
+def save_int4_checkpoint(model, quantized_names, group_size, path):
+    """Saves a quantized model with everything needed to rebuild it without the float32 weights."""
+    state_dict = {key: value for key, value in model.state_dict().items() if not (model.config.tie_word_embeddings and key == "lm_head.weight")}
+    torch.save({"config": model.config.to_dict(),
+                "quantized_names": quantized_names,
+                "group_size": group_size,
+                "state_dict": state_dict}, path + ".tmp")
+    # An interrupted save never leaves a partial checkpoint at `path`
+    os.replace(path + ".tmp", path)
+
+def load_int4_checkpoint(path):
+    """Builds an empty model from the checkpoint's config, swaps in Int4Linear layers and fills in the saved tensors."""
+    checkpoint = torch.load(path, weights_only=False)
+    config = AutoConfig.for_model(**checkpoint["config"])
+    # The float32 parameters are created on the "meta" device, without allocating any memory
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config)
+    for name in checkpoint["quantized_names"]:
+        module = model.get_submodule(name)
+        weight_shape = module.weight.shape if isinstance(module, nn.Linear) else module.weight.shape[::-1]
+        _set_submodule(model, name, Int4Linear(weight_shape[1], weight_shape[0], bias=module.bias is not None,
+                                               group_size=checkpoint["group_size"]))
+    for key, value in checkpoint["state_dict"].items():
+        set_module_tensor_to_device(model, key, "cpu", value=value)
+    model.tie_weights()
+    return model.eval()
+
+# COMMAND ----------
+
+import json
+
+gpt2_xl_tokenizer = GPT2TokenizerFast.from_pretrained("gpt2-xl", cache_dir=DA.paths.datasets+"/models")
+
+def model_mb(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers())) / 1e6
+
+int4_checkpoint_path = os.path.join(DA.paths.working_dir, "gpt2_xl_int4_g128.pt")
+fp32_metrics_path = os.path.join(DA.paths.working_dir, "gpt2_xl_fp32_metrics.json")
+group_size = 128
+
+# Load the float32 model, measure it, quantize it and save the checkpoint, only if no checkpoint exists yet
+if not os.path.exists(int4_checkpoint_path):
+    gpt2_xl = GPT2LMHeadModel.from_pretrained("gpt2-xl", cache_dir=DA.paths.datasets+"/models").eval()
+    with open(fp32_metrics_path, "w") as f:
+        json.dump({"memory_mb": model_mb(gpt2_xl), "perplexity": math.exp(gpt2_loss(gpt2_xl))}, f)
+    quantized_names = quantize_model_int4(gpt2_xl, group_size=group_size)
+    save_int4_checkpoint(gpt2_xl, quantized_names, group_size, int4_checkpoint_path)
+    del gpt2_xl
+
+with open(fp32_metrics_path) as f:
+    fp32_metrics = json.load(f)
+fp32_mb, fp32_ppl = fp32_metrics["memory_mb"], fp32_metrics["perplexity"]
+
+# COMMAND ----------
+
+# Every startup, including the first, loads the pre-quantized checkpoint directly
+start = time.perf_counter()
+gpt2_xl_int4 = load_int4_checkpoint(int4_checkpoint_path)
+load_int4_s = time.perf_counter() - start
+
+int4_mb = model_mb(gpt2_xl_int4)
+int4_ppl = math.exp(gpt2_loss(gpt2_xl_int4))
+quantized_layer_ratio = np.mean([32 / (8 * (m.packed.nbytes + m.scales.nbytes) / (m.in_features * m.out_features))
+                                 for m in gpt2_xl_int4.modules() if isinstance(m, Int4Linear)])
+
+display(pd.DataFrame([
+    {"model": "GPT-2 XL fp32", "memory_mb": fp32_mb, "perplexity": fp32_ppl},
+    {"model": "GPT-2 XL int4 (group 128)", "memory_mb": int4_mb, "perplexity": int4_ppl},
+]))
+print(f"Whole model: {fp32_mb / int4_mb:.1f}x smaller, quantized layers: {quantized_layer_ratio:.1f}x smaller")
+print(f"Checkpoint: {os.path.getsize(int4_checkpoint_path) / 1e6:.0f} MB, loaded in {load_int4_s:.1f}s")
+
+inputs = gpt2_xl_tokenizer("The best way to deploy a large language model is", return_tensors="pt")
+with torch.no_grad():
+    output_ids = gpt2_xl_int4.generate(**inputs, max_new_tokens=20, do_sample=False, pad_token_id=gpt2_xl_tokenizer.eos_token_id)
+print(gpt2_xl_tokenizer.decode(output_ids[0]))
+
+# COMMAND ----------
+
 # MAGIC %md-sandbox
 # MAGIC &copy; 2023 Databricks, Inc. All rights reserved.<br/>
 # MAGIC Apache, Apache Spark, Spark and the Spark logo are trademarks of the <a href="https://www.apache.org/">Apache Software Foundation</a>.<br/>
@@ -205,6 +205,843 @@ dbTestQuestion3_1(distilbert, distilbert_tokenizer, test_input)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC # Section 4: Running Experts Concurrently with Top-k Gating
+# MAGIC
+# MAGIC With soft gating, `pseudo_moe_model` runs GPT-2 XL, BERT and T5 one after the other for every input, even when the gating function gives an expert a weight close to zero. The latency of a request is then the **sum** of the latencies of all three experts.
+# MAGIC
+# MAGIC Real MoE models avoid this in two ways:
+# MAGIC - **Top-k gating**: only the `k` experts with the highest weights run, and experts whose weight falls below a threshold are skipped altogether. The weights of the selected experts are renormalized to sum to one.
+# MAGIC - **Concurrent execution**: the selected experts don't depend on each other, so they can run at the same time. PyTorch releases the Python GIL inside its operators, so a thread pool is enough. Each expert gets its share of the CPU cores for its intra-op parallelism, so that concurrent experts don't fight over the same cores.
+# MAGIC
+# MAGIC The latency of a request is then bounded by the **slowest** selected expert rather than by the sum of all of them.
+
+# COMMAND ----------
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def run_expert(model_name, model, tokenizer, input, num_threads=None):
+    """Runs one expert on `input` the same way `pseudo_moe_model` does, and returns its decoded output and latency."""
+    if num_threads is not None:
+        # With PyTorch's OpenMP backend, this limits the intra-op threads used by operators called from the current thread
+        torch.set_num_threads(num_threads)
+    start = time.perf_counter()
+    inputs = tokenizer(input, return_tensors="pt")
+    with torch.no_grad():
+        if model_name == "t5":
+            # For T5, create a decoder input sequence consisting of only the <BOS> token
+            decoder_inputs = tokenizer(["<pad>"], return_tensors="pt")["input_ids"]
+            outputs = model(**inputs, decoder_input_ids=decoder_inputs)
+        else:
+            outputs = model(**inputs)
+    decoded_output = tokenizer.decode(outputs.logits[0].argmax(-1).tolist())
+    return decoded_output, time.perf_counter() - start
+
+class MoEExecutor:
+    """
+    Runs the top-k experts chosen by a gating function concurrently, on a thread pool.
+
+    Args:
+    gating_function (callable): Returns {model_name: (model, tokenizer, weight)} for an input, like `soft_gating_function`.
+    top_k (int): The maximum number of experts to run per input.
+    weight_threshold (float): Experts with a lower weight are skipped. The best expert always runs.
+    threads_per_expert (int): The intra-op threads of each expert. Defaults to an even split of the CPU cores between `top_k` experts.
+    """
+    def __init__(self, gating_function, top_k=2, weight_threshold=0.05, threads_per_expert=None):
+        self.gating_function = gating_function
+        self.top_k = top_k
+        self.weight_threshold = weight_threshold
+        self.threads_per_expert = threads_per_expert or max(1, os.cpu_count() // top_k)
+        self.pool = ThreadPoolExecutor(max_workers=top_k)
+
+    def select_experts(self, input):
+        """Returns [(model_name, model, tokenizer, weight)] for the selected experts, with their weights renormalized."""
+        experts = self.gating_function(input)
+        ranked = sorted(((name, model, tokenizer, float(weight)) for name, (model, tokenizer, weight) in experts.items()),
+                        key=lambda expert: expert[3], reverse=True)[:self.top_k]
+        selected = [expert for expert in ranked if expert[3] >= self.weight_threshold] or ranked[:1]
+        total_weight = sum(expert[3] for expert in selected)
+        return [(name, model, tokenizer, weight / total_weight) for name, model, tokenizer, weight in selected]
+
+    def __call__(self, input):
+        return self.run_experts(input, self.select_experts(input))
+
+    def run_experts(self, input, selected):
+        futures = [(name, weight, self.pool.submit(run_expert, name, model, tokenizer, input, self.threads_per_expert))
+                   for name, model, tokenizer, weight in selected]
+        # Outputs come back ordered by weight, so the first one is the answer of the most trusted expert
+        results = []
+        for name, weight, future in futures:
+            decoded_output, latency = future.result()
+            results.append({"expert": name, "weight": weight, "output": decoded_output, "latency_s": latency})
+        return results
+
+# COMMAND ----------
+
+moe_executor = MoEExecutor(soft_gating_function, top_k=2, weight_threshold=0.05)
+
+start = time.perf_counter()
+sequential_output = pseudo_moe_model(example_2, gating_function="soft")
+sequential_latency = time.perf_counter() - start
+
+start = time.perf_counter()
+concurrent_output = moe_executor(example_2)
+concurrent_latency = time.perf_counter() - start
+
+print("Soft gating, all experts in sequence:", sequential_output)
+print(f"Latency: {sequential_latency:.2f}s\n")
+for result in concurrent_output:
+    print(f"{result['expert']} (weight {result['weight']:.2f}, {result['latency_s']:.2f}s): {result['output']}")
+print(f"Top-k gating, concurrent experts latency: {concurrent_latency:.2f}s (slowest expert: {max(r['latency_s'] for r in concurrent_output):.2f}s)")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 5: Loading Experts Lazily within a Memory Budget
+# MAGIC
+# MAGIC At the top of this notebook we load GPT-2 XL, BERT and T5 eagerly, and adding DistilBERT as an expert adds one more model to memory. Every expert we add makes the cold start slower and the memory footprint larger, even if the gating function rarely routes to it.
+# MAGIC
+# MAGIC The registry below only knows **how** to load each expert. An expert is loaded the first time the gating function routes to it, and the loaded experts are kept under a RAM budget: when a new expert doesn't fit, the least recently used ones are evicted. To hide the loading time, the registry also keeps a short history of the routing decisions and, in the background, prefetches the expert that was routed to most often recently but isn't loaded yet, as long as it fits in the free budget.
+# MAGIC
+# MAGIC Note: the experts loaded at the top of the notebook stay in memory. In a deployment, the registry would replace that cell; here, you can run `del gpt2, bert, t5` first if your cluster is short on memory.
+
+# COMMAND ----------
+
+import gc
+import threading
+from collections import Counter, OrderedDict, deque
+from transformers import DistilBertForSequenceClassification, DistilBertTokenizer
+
+def model_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+class ExpertRegistry:
+    """
+    Loads experts on first use and keeps them under a memory budget with least-recently-used eviction.
+
+    Callers `acquire_all` the experts of a request before running them and `release` each of them afterwards. An expert that
+    is in use is never evicted. The memory of all the experts of a request is reserved at once, and a request holds no expert
+    while it waits for memory, so two requests can never wait on each other.
+
+    Args:
+    memory_budget_gb (float): The memory the loaded experts may use in total.
+    history_size (int): How many recent routing decisions the prefetcher looks at.
+    prefetch (bool): Whether to load likely experts in the background.
+    wait_timeout_s (float): How long a request may wait for experts in use to be released before giving up.
+    """
+    def __init__(self, memory_budget_gb=8, history_size=32, prefetch=True, wait_timeout_s=300):
+        self.memory_budget = memory_budget_gb * 1e9
+        self.prefetch = prefetch
+        self.wait_timeout_s = wait_timeout_s
+        self.loaders, self.size_hints = {}, {}
+        self.loaded = OrderedDict()  # name -> (model, tokenizer, size in bytes), least recently used first
+        self.reserved = {}  # name -> bytes set aside for a load in progress
+        self.ref_counts = Counter()  # name -> number of callers currently using the expert
+        self.in_flight = {}  # name -> Future of a load in progress
+        self.history = deque(maxlen=history_size)
+        self.condition = threading.Condition(threading.RLock())
+        self.pool = ThreadPoolExecutor(max_workers=2)
+
+    def register(self, name, loader, size_gb=None):
+        """Registers how to load an expert: `loader()` returns (model, tokenizer). `size_gb` lets us make room before loading it."""
+        self.loaders[name] = loader
+        self.size_hints[name] = size_gb * 1e9 if size_gb is not None else 0
+
+    @property
+    def used_bytes(self):
+        return sum(size for _, _, size in self.loaded.values()) + sum(self.reserved.values())
+
+    def acquire(self, name):
+        """Returns (model, tokenizer) for an expert, loading it if needed. The expert can't be evicted until it is released."""
+        return self.acquire_all([name])[name]
+
+    def acquire_all(self, names):
+        """
+        Returns {name: (model, tokenizer)} for the experts `names`, loading the missing ones. Each must be released.
+
+        The experts already loaded are taken and the memory of the missing ones is reserved together, in one step under the lock.
+        Until then nothing is held: the request waits for experts in use by other requests to be released, and fails at once
+        if the selection can never fit in the budget.
+        """
+        names = list(dict.fromkeys(names))
+        deadline = time.monotonic() + self.wait_timeout_s
+        with self.condition:
+            total_bytes = sum(self.loaded[name][2] if name in self.loaded else self.size_hints[name] for name in names)
+            if total_bytes > self.memory_budget:
+                raise MemoryError(f"Experts {names} need {total_bytes / 1e9:.2f} GB together, "
+                                  f"more than the budget of {self.memory_budget / 1e9:.2f} GB")
+            while True:
+                # A load of one of these experts in progress (a prefetch) holds its own reservation: wait for it to finish
+                if not any(name in self.in_flight for name in names):
+                    missing = [name for name in names if name not in self.loaded]
+                    if self._make_room(sum(self.size_hints[name] for name in missing), keep=names):
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise MemoryError(f"Experts {names} didn't fit next to the experts in use within {self.wait_timeout_s}s")
+                self.condition.wait(remaining)
+
+            acquired = {}
+            for name in names:
+                if name in self.loaded:
+                    self.loaded.move_to_end(name)
+                    self.ref_counts[name] += 1
+                    acquired[name] = self.loaded[name][:2]
+            futures = {}
+            for name in missing:
+                self.reserved[name] = self.size_hints[name]
+                futures[name] = self.in_flight[name] = self.pool.submit(self._load, name, True)
+
+        try:
+            for name, future in futures.items():
+                acquired[name] = future.result()
+        except Exception:
+            # Wait for the other loads, and release every expert this request took a reference to
+            for name, future in futures.items():
+                if future.exception() is None:
+                    acquired[name] = future.result()
+            for name in acquired:
+                self.release(name)
+            raise
+        return acquired
+
+    def release(self, name):
+        with self.condition:
+            self.ref_counts[name] -= 1
+            if self.ref_counts[name] <= 0:
+                del self.ref_counts[name]
+                # A request may be waiting for this expert to become evictable
+                self.condition.notify_all()
+
+    def _load(self, name, pin):
+        """Loads an expert whose memory is already reserved. With `pin`, it is returned with a reference taken for the caller."""
+        try:
+            model, tokenizer = self.loaders[name]()
+            model.eval()
+            with self.condition:
+                self.loaded[name] = (model, tokenizer, model_bytes(model))
+                if pin:
+                    self.ref_counts[name] += 1
+                self.reserved.pop(name, None)
+                # The actual size may differ from the hint
+                self._make_room(0, keep=[name])
+            print(f"Loaded expert {name} ({model_bytes(model) / 1e9:.2f} GB), {self.used_bytes / 1e9:.2f} GB in use")
+            return model, tokenizer
+        finally:
+            with self.condition:
+                self.reserved.pop(name, None)
+                self.in_flight.pop(name, None)
+                self.condition.notify_all()
+
+    def _make_room(self, incoming_bytes, keep):
+        """
+        Evicts idle experts, least recently used first, until `incoming_bytes` fit. Returns whether they fit.
+
+        Nothing is evicted if the bytes wouldn't fit even after evicting every idle expert.
+        """
+        # Never evict the experts in `keep`, or one that is still running: its memory wouldn't be freed anyway
+        evictable = [name for name in self.loaded if name not in keep and self.ref_counts[name] == 0]
+        if self.used_bytes - sum(self.loaded[name][2] for name in evictable) + incoming_bytes > self.memory_budget:
+            return False
+        evicted = False
+        for name in evictable:
+            if self.used_bytes + incoming_bytes <= self.memory_budget:
+                break
+            del self.loaded[name]
+            evicted = True
+            print(f"Evicted expert {name}")
+        if evicted:
+            gc.collect()
+        return True
+
+    def record_routing(self, names):
+        """
+        Records a routing decision, and prefetches the most frequently routed expert that isn't loaded yet.
+
+        The experts in `names` are skipped, since the current request is about to load them anyway.
+        """
+        with self.condition:
+            self.history.extend(names)
+            if not self.prefetch:
+                return
+            for name, _ in Counter(self.history).most_common():
+                if name in names or name in self.loaded or name in self.in_flight:
+                    continue
+                # Only prefetch into free memory: a guess should never evict an expert
+                if self.used_bytes + self.size_hints[name] <= self.memory_budget:
+                    self.reserved[name] = self.size_hints[name]
+                    self.in_flight[name] = self.pool.submit(self._load, name, False)
+                break
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC The experts now route by name: the gating function only returns weights, and the executor asks the registry for the models of the experts it selected.
+
+# COMMAND ----------
+
+def soft_gating_weights(input):
+    # Same length-based weights as `soft_gating_function`, plus DistilBERT as a lighter alternative to BERT
+    weights = F.softmax(torch.tensor([len(input), 100 - len(input), len(input), 90 - len(input)], dtype=torch.float), dim=0)
+    return {"gpt2": weights[0], "bert": weights[1], "t5": weights[2], "distilbert": weights[3]}
+
+class LazyMoEExecutor(MoEExecutor):
+    """An `MoEExecutor` whose gating function returns {model_name: weight}, and whose experts come from an `ExpertRegistry`."""
+    def __init__(self, registry, gating_weights_function, **kwargs):
+        super(LazyMoEExecutor, self).__init__(gating_function=None, **kwargs)
+        self.registry = registry
+        self.gating_weights_function = gating_weights_function
+
+    def select_experts(self, input):
+        """Like `MoEExecutor.select_experts`, but the selected experts are acquired from the registry and must be released."""
+        ranked = sorted(((name, float(weight)) for name, weight in self.gating_weights_function(input).items()),
+                        key=lambda expert: expert[1], reverse=True)[:self.top_k]
+        selected = [expert for expert in ranked if expert[1] >= self.weight_threshold] or ranked[:1]
+        self.registry.record_routing([name for name, _ in selected])
+        total_weight = sum(weight for _, weight in selected)
+        # All the selected experts are acquired together, so that a request never waits while holding some of them
+        experts = self.registry.acquire_all([name for name, _ in selected])
+        return [(name, *experts[name], weight / total_weight) for name, weight in selected]
+
+    def __call__(self, input):
+        selected = self.select_experts(input)
+        try:
+            return self.run_experts(input, selected)
+        finally:
+            for name, *_ in selected:
+                self.registry.release(name)
+
+cache_dir = DA.paths.datasets + "/models"
+expert_registry = ExpertRegistry(memory_budget_gb=8)
+expert_registry.register("gpt2", lambda: (GPT2LMHeadModel.from_pretrained("gpt2-XL", cache_dir=cache_dir),
+                                          GPT2Tokenizer.from_pretrained("gpt2-XL", cache_dir=cache_dir)), size_gb=6.5)
+expert_registry.register("bert", lambda: (BertForSequenceClassification.from_pretrained("bert-base-uncased", cache_dir=cache_dir),
+                                          BertTokenizer.from_pretrained("bert-base-uncased", cache_dir=cache_dir)), size_gb=0.45)
+expert_registry.register("t5", lambda: (T5ForConditionalGeneration.from_pretrained("t5-base", cache_dir=cache_dir),
+                                        T5Tokenizer.from_pretrained("t5-base", cache_dir=cache_dir)), size_gb=0.9)
+expert_registry.register("distilbert", lambda: (DistilBertForSequenceClassification.from_pretrained("distilbert-base-uncased", cache_dir=cache_dir),
+                                                DistilBertTokenizer.from_pretrained("distilbert-base-uncased", cache_dir=cache_dir)), size_gb=0.27)
+
+lazy_moe_executor = LazyMoEExecutor(expert_registry, soft_gating_weights, top_k=2, weight_threshold=0.05)
+
+# COMMAND ----------
+
+# Nothing is loaded until the first request is routed
+for input in ["Hi there", example_1, example_2, "Translate to german: Thank you.", example_2]:
+    start = time.perf_counter()
+    results = lazy_moe_executor(input)
+    print(f"{[result['expert'] for result in results]} in {time.perf_counter() - start:.2f}s, loaded: {list(expert_registry.loaded)}\n")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 6: Routing Batches of Requests
+# MAGIC
+# MAGIC `pseudo_moe_model` handles one input string at a time: it runs the gating function, tokenizes the input and calls the chosen expert with a batch of size 1. Serving many requests that way leaves most of the CPU idle, since a batch of one barely uses the parallelism of a matrix multiplication, and the throughput grows with the number of requests rather than with the batch size.
+# MAGIC
+# MAGIC The batched router below takes a list of inputs and:
+# MAGIC 1. Runs the gating function on all of them at once, as tensor operations on their lengths.
+# MAGIC 1. Groups the requests by the expert(s) they were routed to.
+# MAGIC 1. Runs each expert once per group (in chunks of at most `max_batch_size`), padding the inputs of the group to the same length.
+# MAGIC 1. Scatters the outputs back, so that the i-th result belongs to the i-th input.
+
+# COMMAND ----------
+
+EXPERT_NAMES = ["gpt2", "bert", "t5"]
+EXPERTS = {"gpt2": (gpt2, gpt2_tokenizer), "bert": (bert, bert_tokenizer), "t5": (t5, t5_tokenizer)}
+
+# GPT-2 doesn't have a pad token, and padding is needed to batch inputs of different lengths
+if gpt2_tokenizer.pad_token is None:
+    gpt2_tokenizer.pad_token = gpt2_tokenizer.eos_token
+
+def batched_gating(inputs, gating_function="hard", top_k=1):
+    """
+    Vectorized version of the hard and soft gating functions.
+
+    Returns:
+    tuple: The indices into EXPERT_NAMES of the selected experts, of shape (len(inputs), top_k), and their weights.
+    """
+    lengths = torch.tensor([len(input) for input in inputs], dtype=torch.float)
+    if gating_function == "hard":
+        # < 10 characters: GPT-2, < 100 characters: T5, otherwise BERT
+        expert_index = torch.where(lengths < 10, 0, torch.where(lengths < 100, 2, 1))
+        return expert_index.unsqueeze(1), torch.ones(len(inputs), 1)
+    # Same weights as soft_gating_function, one row per input
+    weights = F.softmax(torch.stack([lengths, 100 - lengths, lengths], dim=1), dim=1)
+    top_weights, top_index = weights.topk(top_k, dim=1)
+    return top_index, top_weights / top_weights.sum(dim=1, keepdim=True)
+
+def run_expert_batch(model_name, model, tokenizer, batch_inputs):
+    """Runs one expert on a padded batch of inputs and decodes each row the same way `pseudo_moe_model` does."""
+    encoded = tokenizer(batch_inputs, return_tensors="pt", padding=True)
+    with torch.no_grad():
+        if model_name == "t5":
+            # Same decoder input as `pseudo_moe_model` for every row: "<pad>" tokenized, i.e. the <BOS> token followed by </s>
+            decoder_inputs = tokenizer(["<pad>"] * len(batch_inputs), return_tensors="pt")["input_ids"]
+            logits = model(**encoded, decoder_input_ids=decoder_inputs).logits
+        else:
+            logits = model(**encoded).logits
+
+    decoded_outputs = []
+    for i in range(len(batch_inputs)):
+        row_logits = logits[i]
+        if model_name == "gpt2":
+            # Drop the predictions made at padding positions
+            row_logits = row_logits[encoded["attention_mask"][i].bool()]
+        decoded_outputs.append(tokenizer.decode(row_logits.argmax(-1).tolist()))
+    return decoded_outputs
+
+def batched_moe_model(inputs, gating_function="hard", top_k=1, max_batch_size=16):
+    """
+    Routes a list of inputs to their experts in batches.
+
+    Returns:
+    list: For each input, in order, a list of (model_name, weight, decoded_output) for its selected experts.
+    """
+    expert_index, expert_weights = batched_gating(inputs, gating_function, top_k)
+
+    results = [[] for _ in inputs]
+    for e, model_name in enumerate(EXPERT_NAMES):
+        # All the (request, slot) pairs routed to this expert
+        rows, slots = (expert_index == e).nonzero(as_tuple=True)
+        if len(rows) == 0:
+            continue
+        model, tokenizer = EXPERTS[model_name]
+        for start in range(0, len(rows), max_batch_size):
+            chunk = rows[start:start + max_batch_size].tolist()
+            decoded_outputs = run_expert_batch(model_name, model, tokenizer, [inputs[i] for i in chunk])
+            for i, slot, decoded_output in zip(chunk, slots[start:start + max_batch_size].tolist(), decoded_outputs):
+                results[i].append((model_name, expert_weights[i, slot].item(), decoded_output))
+
+    # Within a request, list the experts by decreasing weight
+    return [sorted(request_results, key=lambda result: result[1], reverse=True) for request_results in results]
+
+# COMMAND ----------
+
+request_batch = [example_1, example_2, "Hi!", "Translate to german: Good morning.", "Summarize: " + example_2 * 2, "Yes"] * 4
+
+start = time.perf_counter()
+one_by_one = [pseudo_moe_model(input, gating_function="hard") for input in request_batch]
+one_by_one_s = time.perf_counter() - start
+
+start = time.perf_counter()
+batched = batched_moe_model(request_batch, gating_function="hard")
+batched_s = time.perf_counter() - start
+
+# Same expert and same decoded output for every request, in the same order. Padding only adds masked positions, so the
+# predictions of the real positions are the same up to floating-point rounding
+mismatches = [i for i, (single, batch) in enumerate(zip(one_by_one, batched)) if single != (batch[0][0], batch[0][2])]
+print(f"{len(request_batch) - len(mismatches)}/{len(request_batch)} requests match pseudo_moe_model, mismatches: {mismatches}")
+print(f"One request at a time: {len(request_batch) / one_by_one_s:.1f} requests/s")
+print(f"Batched: {len(request_batch) / batched_s:.1f} requests/s")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 7: A Cost-Aware Learned Gating Network
+# MAGIC
+# MAGIC The hard and soft gating functions only look at `len(input)`. Every short input goes to GPT-2 XL, the most expensive expert, whether it needs it or not. A better router knows two things about every expert:
+# MAGIC - **Its cost**, which we measure with a small profiler: the latency of an expert grows roughly linearly with the number of input tokens, so we fit `latency = intercept + slope * num_tokens` for each expert.
+# MAGIC - **Its quality on a given input**, which a small MLP learns to predict from a sentence embedding of the input. The quality of an expert is measured on labelled probes, prompts with a reference answer: it is the fraction of the words of the reference found in the decoded output of the expert.
+# MAGIC
+# MAGIC The quality has to be on the same scale for every expert. The confidence of an expert (its max softmax probability) is not: it depends on the size of its vocabulary or on its number of classes, and BERT's randomly initialized 2-class head is never less than 50% confident. Comparing decoded outputs with a reference works whatever the vocabulary, and correctly gives no credit to the untrained classifier. In the same way, the cost of an expert is estimated from the number of tokens produced by its **own** tokenizer.
+# MAGIC
+# MAGIC The router then picks the **cheapest expert whose predicted quality meets a target**, and falls back to the expert with the best predicted quality when none does. Since the quality target is only applied at routing time, it can be changed without retraining.
+# MAGIC
+# MAGIC The router has to be much cheaper than the experts. The sentence embedding is the mean of BERT's input word embeddings (a table lookup, no transformer layers) and is cached per input together with the token counts of every expert, so that routing a repeated input takes well under a millisecond.
+
+# COMMAND ----------
+
+import re
+import numpy as np
+import pandas as pd
+from torch import nn
+
+# Labelled probes: (prompt, reference answer)
+calibration_probes = [
+    ("Translate to german: The house is wonderful.", "Das Haus ist wunderbar."),
+    ("Translate to german: I would like a cup of coffee.", "Ich möchte eine Tasse Kaffee."),
+    ("Translate to french: Where is the train station?", "Où est la gare?"),
+    ("Translate to german: Thank you very much.", "Vielen Dank."),
+    ("Translate to french: Good morning!", "Bonjour!"),
+    ("Translate to german: The weather is nice today.", "Das Wetter ist heute schön."),
+    ("Translate to french: I love reading books.", "J'adore lire des livres."),
+    (example_1, "Dies ist eine kurze Eingabe."),
+    ("Summarize: The meeting was moved to Friday because half of the team is travelling on Thursday.", "The meeting was moved to Friday."),
+    ("Summarize: The quarterly report shows that revenue grew by ten percent while costs stayed flat, mostly thanks to the new subscription plans.", "Revenue grew by ten percent."),
+    ("Summarize: Large language models are trained on huge amounts of text. They can answer questions, write code and translate between languages, but serving them is expensive because every request has to go through billions of parameters.", "Serving large language models is expensive."),
+    ("Translate to german: Mixture-of-experts models only run a few of their experts for every input, which keeps the cost of inference low even when the total number of parameters is very large.", "Mixture-of-Experts-Modelle führen für jede Eingabe nur wenige ihrer Experten aus."),
+    ("The capital of France is", "Paris"),
+    ("The Eiffel Tower is located in", "Paris"),
+    ("One, two, three, four,", "five"),
+    ("Monday, Tuesday, Wednesday,", "Thursday"),
+    ("January, February, March,", "April"),
+    ("The opposite of hot is", "cold"),
+    ("Water is made of hydrogen and", "oxygen"),
+    ("Once upon a time, there", "was"),
+    ("The sun rises in the", "east"),
+    ("Review: The movie was absolutely fantastic, I loved every minute of it. Sentiment:", "positive"),
+    ("Review: The food was cold and the service was terribly slow. Sentiment:", "negative"),
+    ("Review: Terrible. Sentiment:", "negative"),
+]
+calibration_prompts = [prompt for prompt, _ in calibration_probes]
+
+def answer_words(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+def expert_quality(model_name, model, tokenizer, input, reference):
+    """The quality of an expert on a labelled probe: the fraction of the words of the `reference` answer found in its decoded output."""
+    reference_words = answer_words(reference)
+    decoded_output = run_expert(model_name, model, tokenizer, input)[0]
+    return len(reference_words & answer_words(decoded_output)) / len(reference_words)
+
+def profile_expert_costs(prompts, n_repeats=3):
+    """
+    Measures the latency of every expert on `prompts` and fits a linear cost model on the number of input tokens.
+
+    Returns:
+    dict: {model_name: (intercept_ms, slope_ms_per_token)}
+    """
+    costs = {}
+    for model_name in EXPERT_NAMES:
+        model, tokenizer = EXPERTS[model_name]
+        run_expert(model_name, model, tokenizer, prompts[0])  # warm-up
+        num_tokens, latencies_ms = [], []
+        for prompt in prompts:
+            latency = min(run_expert(model_name, model, tokenizer, prompt)[1] for _ in range(n_repeats))
+            num_tokens.append(len(tokenizer(prompt)["input_ids"]))
+            latencies_ms.append(latency * 1000)
+        slope, intercept = np.polyfit(num_tokens, latencies_ms, deg=1)
+        costs[model_name] = (intercept, max(slope, 0.0))
+    return costs
+
+class SentenceEmbedder:
+    """Mean of BERT's input word embeddings plus the log of the number of tokens, cached per input."""
+    def __init__(self, tokenizer, word_embeddings):
+        self.tokenizer = tokenizer
+        self.word_embeddings = word_embeddings
+        self.cache = {}
+
+    def __call__(self, input):
+        features = self.cache.get(input)
+        if features is None:
+            input_ids = torch.tensor(self.tokenizer(input)["input_ids"])
+            with torch.no_grad():
+                mean_embedding = self.word_embeddings(input_ids).mean(dim=0)
+            features = torch.cat([mean_embedding, torch.tensor([np.log(len(input_ids))], dtype=mean_embedding.dtype)])
+            self.cache[input] = features
+        return features
+
+class CostAwareRouter(nn.Module):
+    """
+    An MLP that predicts the quality of every expert on an input, and routes the input to the cheapest expert that meets a quality target.
+
+    Args:
+    embedder (SentenceEmbedder): Turns an input into a feature vector.
+    expert_costs (dict): {model_name: (intercept_ms, slope_ms_per_token)}, as returned by `profile_expert_costs`.
+    quality_target (float): The minimum predicted quality of the selected expert.
+    hidden_size (int): The width of the hidden layer of the MLP.
+    """
+    def __init__(self, embedder, expert_costs, quality_target=0.5, hidden_size=64):
+        super(CostAwareRouter, self).__init__()
+        self.embedder = embedder
+        self.quality_target = quality_target
+        input_size = embedder.word_embeddings.embedding_dim + 1
+        self.mlp = nn.Sequential(nn.Linear(input_size, hidden_size), nn.ReLU(), nn.Linear(hidden_size, len(EXPERT_NAMES)))
+        self.register_buffer("cost_intercept", torch.tensor([expert_costs[name][0] for name in EXPERT_NAMES]))
+        self.register_buffer("cost_slope", torch.tensor([expert_costs[name][1] for name in EXPERT_NAMES]))
+        self.token_count_cache = {}
+
+    def forward(self, features):
+        # Predicted quality of every expert, between 0 and 1
+        return torch.sigmoid(self.mlp(features))
+
+    def fit(self, prompts, quality, epochs=300, lr=1e-2):
+        """Trains the MLP to regress the measured `quality` of shape (len(prompts), num_experts)."""
+        features = torch.stack([self.embedder(prompt) for prompt in prompts])
+        optimizer = torch.optim.Adam(self.mlp.parameters(), lr=lr)
+        self.train()
+        for _ in range(epochs):
+            optimizer.zero_grad()
+            loss = F.mse_loss(self(features), quality)
+            loss.backward()
+            optimizer.step()
+        self.eval()
+        return loss.item()
+
+    def token_counts(self, input):
+        """The number of tokens of `input` for every expert, counted with the expert's own tokenizer and cached per input."""
+        num_tokens = self.token_count_cache.get(input)
+        if num_tokens is None:
+            num_tokens = torch.tensor([len(EXPERTS[name][1](input)["input_ids"]) for name in EXPERT_NAMES], dtype=self.cost_slope.dtype)
+            self.token_count_cache[input] = num_tokens
+        return num_tokens
+
+    def estimated_cost_ms(self, input):
+        return self.cost_intercept + self.cost_slope * self.token_counts(input)
+
+    def route(self, input):
+        """Returns the index into EXPERT_NAMES of the cheapest expert predicted to meet the quality target."""
+        features = self.embedder(input)
+        with torch.no_grad():
+            predicted_quality = self(features)
+        cost = self.estimated_cost_ms(input)
+        meets_target = predicted_quality >= self.quality_target
+        if not meets_target.any():
+            return int(predicted_quality.argmax())
+        return int(torch.where(meets_target, cost, torch.full_like(cost, float("inf"))).argmin())
+
+    def gating_function(self, input):
+        """Same interface as `hard_gating_function`."""
+        model_name = EXPERT_NAMES[self.route(input)]
+        return (model_name,) + EXPERTS[model_name]
+
+# COMMAND ----------
+
+# Measure the cost and the quality of every expert on the calibration prompts
+expert_costs = profile_expert_costs(calibration_prompts)
+quality = torch.tensor([[expert_quality(name, *EXPERTS[name], prompt, reference) for name in EXPERT_NAMES]
+                        for prompt, reference in calibration_probes])
+
+display(pd.DataFrame({"intercept (ms)": [expert_costs[name][0] for name in EXPERT_NAMES],
+                      "ms per token": [expert_costs[name][1] for name in EXPERT_NAMES],
+                      "mean quality": quality.mean(dim=0).tolist()}, index=EXPERT_NAMES))
+
+# Hold out a few prompts to evaluate the router
+generator = torch.Generator().manual_seed(0)
+permutation = torch.randperm(len(calibration_prompts), generator=generator).tolist()
+train_index, test_index = permutation[:18], permutation[18:]
+
+embedder = SentenceEmbedder(bert_tokenizer, bert.bert.embeddings.word_embeddings)
+router = CostAwareRouter(embedder, expert_costs, quality_target=0.5)
+train_loss = router.fit([calibration_prompts[i] for i in train_index], quality[train_index])
+print(f"Router training loss: {train_loss:.4f}")
+
+# COMMAND ----------
+
+def compare_routers(router, prompts, quality, index):
+    """Compares the estimated cost and the quality of the hard gating function and of the learned router on `prompts[index]`."""
+    rows = []
+    for name, route in [("hard gating", lambda prompt: EXPERT_NAMES.index(hard_gating_function(prompt)[0])),
+                        ("learned router", router.route)]:
+        choices = [route(prompts[i]) for i in index]
+        costs = [router.estimated_cost_ms(prompts[i])[choice].item() for i, choice in zip(index, choices)]
+        qualities = [quality[i, choice].item() for i, choice in zip(index, choices)]
+        rows.append({"router": name,
+                     "estimated cost (ms)": np.mean(costs),
+                     "mean quality": np.mean(qualities),
+                     "meets target": np.mean([q >= router.quality_target for q in qualities])})
+    return pd.DataFrame(rows)
+
+display(compare_routers(router, calibration_prompts, quality, test_index))
+
+# Routing overhead, with the embeddings of the inputs already cached and without
+uncached_s, cached_s = [], []
+for prompt in calibration_prompts:
+    embedder.cache.pop(prompt, None)
+    router.token_count_cache.pop(prompt, None)
+    start = time.perf_counter()
+    router.route(prompt)
+    uncached_s.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    router.route(prompt)
+    cached_s.append(time.perf_counter() - start)
+print(f"Routing overhead: {np.mean(uncached_s) * 1000:.3f} ms uncached, {np.mean(cached_s) * 1000:.3f} ms cached")
+
+model_name, model, tokenizer = router.gating_function(example_1)
+print(f"{example_1!r} routed to {model_name}: {run_expert(model_name, model, tokenizer, example_1)[0]}")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Section 8: Distilling GPT-2 XL into GPT-2 Small
+# MAGIC
+# MAGIC GPT-2 XL is by far the most expensive of our experts. **Knowledge distillation** trains a smaller *student* model (GPT-2 small, about 12x fewer parameters, same tokenizer) to reproduce the next-token distributions of the *teacher* rather than only the one-hot next tokens of the text, which carries much more information per token.
+# MAGIC
+# MAGIC Running the teacher is the expensive part of distillation, and its outputs don't change between epochs. So we run it **once**:
+# MAGIC 1. Stream the training texts through the teacher in batches, and keep only the `top_k` largest logits of every position (with their token ids). The full distribution over 50,257 tokens would take about 100 KB per token in float16, the top 32 take 192 bytes.
+# MAGIC 1. Write them to disk in shards of a fixed number of sequences as soon as a shard is full, so that memory stays constant and an interrupted run resumes from the last complete shard. A manifest records the teacher, the tokenizer, `top_k`, `max_length`, the shard size and a hash of the texts; when any of them changes, the old shards are deleted and the cache is rebuilt.
+# MAGIC 1. Train the student for as many epochs as we like by reading the shards back.
+# MAGIC
+# MAGIC The loss combines the KL divergence to the teacher distribution, renormalized over its top-k tokens and softened by a temperature, with the usual next-token cross-entropy.
+
+# COMMAND ----------
+
+import glob
+import hashlib
+import json
+import math
+import random
+from datasets import load_dataset
+from torch.utils.data import IterableDataset, DataLoader
+
+def cache_teacher_topk(teacher, tokenizer, texts, cache_dir, top_k=32, max_length=64, batch_size=8, shard_size=512):
+    """
+    Runs the teacher once over `texts` and writes its top-k logits to shards on disk.
+
+    Args:
+    teacher (PreTrainedModel): The causal language model to distill.
+    texts (list): The training texts.
+    cache_dir (str): Where to write the shards and a manifest. Shards built for a different manifest are deleted.
+    top_k (int): The number of logits to keep per position.
+    max_length (int): Texts are truncated and padded to this many tokens.
+    batch_size (int): The batch size of the teacher.
+    shard_size (int): The number of sequences per shard. Must be a multiple of `batch_size`.
+
+    Returns:
+    list: The paths of the shards.
+    """
+    assert shard_size % batch_size == 0
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = {"teacher": teacher.config._name_or_path, "tokenizer": tokenizer.name_or_path,
+                "top_k": top_k, "max_length": max_length, "shard_size": shard_size, "num_texts": len(texts),
+                "texts_sha256": hashlib.sha256("\0".join(texts).encode("utf-8")).hexdigest()}
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    cached_manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            cached_manifest = json.load(f)
+    if cached_manifest != manifest:
+        # The shards on disk, if any, were built for another request
+        for path in glob.glob(os.path.join(cache_dir, "shard_*.pt*")):
+            os.remove(path)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+    teacher.eval()
+    shard_paths = []
+    for shard_start in range(0, len(texts), shard_size):
+        shard_path = os.path.join(cache_dir, f"shard_{shard_start // shard_size:05d}.pt")
+        shard_paths.append(shard_path)
+        if os.path.exists(shard_path):
+            # Written by a previous run
+            continue
+        shard = {"input_ids": [], "attention_mask": [], "topk_values": [], "topk_indices": []}
+        for start in range(shard_start, min(shard_start + shard_size, len(texts)), batch_size):
+            inputs = tokenizer(texts[start:start + batch_size], truncation=True, max_length=max_length,
+                               padding="max_length", return_tensors="pt")
+            with torch.no_grad():
+                logits = teacher(**inputs).logits
+            topk_values, topk_indices = logits.topk(top_k, dim=-1)
+            shard["input_ids"].append(inputs["input_ids"].int())
+            shard["attention_mask"].append(inputs["attention_mask"].bool())
+            shard["topk_values"].append(topk_values.half())
+            shard["topk_indices"].append(topk_indices.int())
+        # Write to a temporary file first, so that a partial shard is never mistaken for a complete one
+        torch.save({key: torch.cat(values) for key, values in shard.items()}, shard_path + ".tmp")
+        os.replace(shard_path + ".tmp", shard_path)
+    return shard_paths
+
+class TeacherLogitsDataset(IterableDataset):
+    """Streams the cached sequences shard by shard, in a new random order of shards and of sequences within each shard every epoch."""
+    def __init__(self, shard_paths, seed=42):
+        self.shard_paths = shard_paths
+        self.rng = random.Random(seed)
+
+    def __iter__(self):
+        shard_paths = list(self.shard_paths)
+        self.rng.shuffle(shard_paths)
+        for shard_path in shard_paths:
+            shard = torch.load(shard_path)
+            for i in torch.randperm(len(shard["input_ids"])).tolist():
+                yield {key: value[i] for key, value in shard.items()}
+
+def distillation_loss(student_logits, batch, temperature=2.0, alpha=0.5):
+    """KL divergence to the teacher's top-k distribution, mixed with the next-token cross-entropy."""
+    mask = batch["attention_mask"]
+    topk_indices = batch["topk_indices"].long()
+    teacher_log_probs = F.log_softmax(batch["topk_values"].float() / temperature, dim=-1)
+    student_log_probs = F.log_softmax(student_logits / temperature, dim=-1).gather(-1, topk_indices)
+    # Renormalize the student over the same top-k tokens as the teacher
+    student_log_probs = student_log_probs - student_log_probs.logsumexp(dim=-1, keepdim=True)
+    kl = (teacher_log_probs.exp() * (teacher_log_probs - student_log_probs)).sum(dim=-1)
+    kd_loss = (kl * mask).sum() / mask.sum() * temperature ** 2
+
+    labels = batch["input_ids"].long().masked_fill(~mask, -100)
+    ce_loss = F.cross_entropy(student_logits[:, :-1].flatten(0, 1), labels[:, 1:].flatten())
+    return alpha * kd_loss + (1 - alpha) * ce_loss
+
+def train_student(student, dataset, num_epochs=3, batch_size=16, lr=5e-5, temperature=2.0, alpha=0.5):
+    data_loader = DataLoader(dataset, batch_size=batch_size)
+    optimizer = torch.optim.AdamW(student.parameters(), lr=lr)
+    student.train()
+    for epoch in range(num_epochs):
+        total_loss, num_batches = 0.0, 0
+        for batch in data_loader:
+            optimizer.zero_grad()
+            logits = student(input_ids=batch["input_ids"].long(), attention_mask=batch["attention_mask"].long()).logits
+            loss = distillation_loss(logits, batch, temperature, alpha)
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item()
+            num_batches += 1
+        print(f"Epoch {epoch + 1}: loss {total_loss / num_batches:.4f}")
+    student.eval()
+    return student
+
+def perplexity(model, tokenizer, texts, max_length=64, batch_size=8):
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model.eval()
+    total_nll, total_tokens = 0.0, 0
+    for start in range(0, len(texts), batch_size):
+        inputs = tokenizer(texts[start:start + batch_size], truncation=True, max_length=max_length, padding=True, return_tensors="pt")
+        labels = inputs["input_ids"].masked_fill(inputs["attention_mask"] == 0, -100)
+        with torch.no_grad():
+            logits = model(**inputs).logits
+        nll = F.cross_entropy(logits[:, :-1].flatten(0, 1), labels[:, 1:].flatten(), reduction="sum")
+        total_nll += nll.item()
+        total_tokens += (labels[:, 1:] != -100).sum().item()
+    return math.exp(total_nll / total_tokens)
+
+# COMMAND ----------
+
+quotes = load_dataset("Abirate/english_quotes", cache_dir=DA.paths.datasets+"/datasets")["train"]["quote"]
+train_texts, eval_texts = quotes[:2000], quotes[2000:2200]
+
+teacher_cache_dir = os.path.join(DA.paths.working_dir, "gpt2_xl_topk")
+start = time.perf_counter()
+shard_paths = cache_teacher_topk(gpt2, gpt2_tokenizer, train_texts, teacher_cache_dir, top_k=32)
+print(f"Teacher logits cached in {time.perf_counter() - start:.1f}s, {len(shard_paths)} shards")
+
+student = GPT2LMHeadModel.from_pretrained("gpt2", cache_dir=DA.paths.datasets+"/models")
+student_ppl_before = perplexity(student, gpt2_tokenizer, eval_texts)
+student = train_student(student, TeacherLogitsDataset(shard_paths), num_epochs=3)
+
+# COMMAND ----------
+
+def generation_latency(model, tokenizer, prompt, max_new_tokens=32, n_iters=3):
+    inputs = tokenizer(prompt, return_tensors="pt")
+    latencies = []
+    for _ in range(n_iters):
+        start = time.perf_counter()
+        with torch.no_grad():
+            model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+        latencies.append(time.perf_counter() - start)
+    return min(latencies)
+
+teacher_ppl = perplexity(gpt2, gpt2_tokenizer, eval_texts)
+student_ppl = perplexity(student, gpt2_tokenizer, eval_texts)
+teacher_latency = generation_latency(gpt2, gpt2_tokenizer, example_1)
+student_latency = generation_latency(student, gpt2_tokenizer, example_1)
+
+def num_parameters_m(model):
+    return sum(p.numel() for p in model.parameters()) / 1e6
+
+display(pd.DataFrame([
+    {"model": "GPT-2 XL (teacher)", "parameters (M)": num_parameters_m(gpt2), "perplexity": teacher_ppl, "latency_s": teacher_latency},
+    {"model": "GPT-2 small (before distillation)", "parameters (M)": num_parameters_m(student), "perplexity": student_ppl_before, "latency_s": student_latency},
+    {"model": "GPT-2 small (distilled)", "parameters (M)": num_parameters_m(student), "perplexity": student_ppl, "latency_s": student_latency},
+]))
+print(f"Quality gap: {student_ppl / teacher_ppl:.2f}x the teacher's perplexity (was {student_ppl_before / teacher_ppl:.2f}x)")
+print(f"Serving speedup: {teacher_latency / student_latency:.1f}x")
+
+# COMMAND ----------
+
 # MAGIC %md-sandbox
 # MAGIC &copy; 2023 Databricks, Inc. All rights reserved.<br/>
 # MAGIC Apache, Apache Spark, Spark and the Spark logo are trademarks of the <a href="https://www.apache.org/">Apache Software Foundation</a>.<br/>